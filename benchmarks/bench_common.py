@@ -0,0 +1,67 @@
+"""
+Helpers shared by the benchmarks
+They run both on a host python and on the MicroPython unix port, from the repository root:
+
+    PYTHONPATH=. python benchmarks/<benchmark>.py
+    MICROPYPATH=.:benchmarks micropython benchmarks/<benchmark>.py
+"""
+
+import gc
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # MicroPython, heap usage is measured with gc.mem_alloc
+    tracemalloc = None
+
+
+def _now():
+    try:
+        return time.ticks_us()
+    except AttributeError:
+        return time.perf_counter_ns() // 1000
+
+
+def measure_time(fn, iterations):
+    """Returns the average time per `fn()` call in microseconds"""
+    gc.collect()
+    started_at = _now()
+    for _ in range(iterations):
+        fn()
+    return (_now() - started_at) / iterations
+
+
+def measure_alloc(fn, iterations):
+    """
+    Returns the average amount of heap bytes allocated by a `fn()` call
+    On MicroPython it's everything allocated with the GC disabled,
+    on the host it's the peak of memory held during the call, which is as close as tracemalloc gets
+    """
+    fn()  # Warm up, so lazily created objects and caches are not counted
+    gc.collect()
+    if tracemalloc is None:
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(iterations):
+            fn()
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        return allocated / iterations
+
+    allocated = 0
+    tracemalloc.start()
+    for _ in range(iterations):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn()
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return allocated / iterations
+
+
+def report(name, fn, iterations=1000):
+    """Measure `fn` and print a single report line"""
+    print("{0:<40} {1:>10.1f} us/call {2:>8.1f} bytes/call".format(
+        name, measure_time(fn, iterations), measure_alloc(fn, iterations),
+    ))
@@ -0,0 +1,27 @@
+"""
+Size and cost of gzipping the metrics bodies: a single probe of power lines, and a minute-long batch of them
+"""
+
+from bench_common import report
+
+from compression import gzip_parts
+from dts6619_emulator import DTS6619Emulator
+from dts6619_modbus import DTS6619
+from line_protocol import format_lines_multi
+
+fields = DTS6619.PROFILE.metric_fields(DTS6619Emulator.DEFAULT_VALUES)
+
+
+def probe_lines(timestamp):
+    return format_lines_multi('power', {'localtion': 'workshop'}, fields, timestamp)
+
+
+for cycles in (1, 12):
+    parts = [probe_lines(1700000000000000000 + i * 5000000000) for i in range(cycles)]
+    plain = sum(len(part) + 1 for part in parts) - 1
+    for window_bits in (9, 10, 12):
+        compressed = len(gzip_parts(parts, window_bits))
+        print("{0:>2} probe(s), window 2^{1:<2} {2:>6} -> {3:>5} bytes, {4:.1f}x".format(
+            cycles, window_bits, plain, compressed, plain / compressed,
+        ))
+    report("{0} probe(s) gzip".format(cycles), lambda: gzip_parts(parts), 100)
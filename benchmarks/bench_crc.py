@@ -0,0 +1,74 @@
+"""
+Benchmark of the CRC16 backends, in bytes per second over a full-size Modbus RTU frame
+The viper and native backends are only available on MicroPython ports built with these emitters
+"""
+
+from array import array
+
+from bench_common import measure_time
+
+from modbus import crc
+
+FRAME = bytes(range(256))
+
+
+# The table of the previous implementation, a tuple of the same values
+LEGACY_CRC16_TABLE = tuple(crc.CRC16_TABLE)
+
+
+def swap_bytes(word_val):
+    """swap lsb and msb of a word"""
+    msb = (word_val >> 8) & 0xFF
+    lsb = word_val & 0xFF
+    return (lsb << 8) + msb
+
+
+def legacy_calculate_crc(data):
+    """The previous implementation, as it was"""
+    crc = 0xFFFF
+
+    for c in data:
+        crc = (crc >> 8) ^ LEGACY_CRC16_TABLE[((c) ^ crc) & 0xFF]
+
+    return swap_bytes(crc)
+
+
+def report(name, fn, iterations=200):
+    us_per_frame = measure_time(fn, iterations)
+    print("{0:<24} {1:>12.0f} bytes/s".format(name, len(FRAME) * 1000000 / us_per_frame))
+
+
+backends = [('python', None)]
+for backend in ('crc_native', 'crc_viper'):
+    try:
+        backends.append((backend[4:], __import__('modbus.' + backend, None, None, ['crc16_update']).crc16_update))
+    except (ImportError, SyntaxError):
+        print("{0:<24} {1:>12}".format(backend[4:], 'unavailable'))
+
+print("selected backend:", crc.BACKEND)
+expected = legacy_calculate_crc(FRAME)
+report("legacy", lambda: legacy_calculate_crc(FRAME))
+
+for name, update in backends:
+    if update is None:
+        # The python backend is only defined when nothing faster is available, so keep a copy of it here
+        def update(value, data, length, table):
+            if length != len(data):
+                data = memoryview(data)[:length]
+            for c in data:
+                value = (value >> 8) ^ table[(c ^ value) & 0xFF]
+            return value
+
+    # Viper needs the array, the python backend is given a tuple as it indexes it faster
+    tables = [('array', array('H', crc.CRC16_TABLE))]
+    if name != 'viper':
+        tables.append(('tuple', tuple(crc.CRC16_TABLE)))
+    for table_name, table in tables:
+        def calculate(update=update, table=table):
+            value = update(0xFFFF, FRAME, len(FRAME), table)
+            return ((value & 0xFF) << 8) | (value >> 8)
+
+        assert calculate() == expected
+        report("{0} ({1})".format(name, table_name), calculate)
+
+report("calculate_crc ({0})".format(crc.BACKEND), lambda: crc.calculate_crc(FRAME))
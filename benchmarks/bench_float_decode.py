@@ -0,0 +1,38 @@
+"""
+Benchmark of the DTS6619 float decoding: the legacy per-value word swapping
+against decoding the raw register bytes with a single struct format
+"""
+
+import struct
+
+from bench_common import report
+
+VALUES = (230.5, 229.75, 231.25, 1.5, 2.25, 0.125, 812.0, 301.5, 250.25, 260.25, -12.5, -4.0, -4.25, -4.25)
+# Raw register bytes the way they come from the meter
+RAW = struct.pack(">{0}f".format(len(VALUES)), *VALUES)
+WORDS = struct.unpack(">{0}H".format(len(VALUES) * 2), RAW)
+
+
+def decode_legacy(word_pair, expected_quantity):
+    """Copy of the decoder used before, working on the tuple of words unpacked by `execute`"""
+    return_data = []
+    for i in range(0, expected_quantity * 2, 2):
+        # MicroPython doesn't range check '<h', CPython needs '<H' for words above 0x7FFF
+        parsed = struct.unpack('<f', struct.pack('<H', int(word_pair[i + 1])) + struct.pack('<H', int(word_pair[i])))[0]
+        return_data.append(parsed)
+    return return_data
+
+
+FORMAT = ">{0}f".format(len(VALUES))
+
+
+def decode_single_pass(data):
+    return struct.unpack_from(FORMAT, data)
+
+
+assert tuple(decode_legacy(WORDS, len(VALUES))) == VALUES
+assert decode_single_pass(RAW) == VALUES
+
+report("legacy: words -> pack/unpack per value", lambda: decode_legacy(WORDS, len(VALUES)))
+report("legacy incl. '>H' unpack in execute", lambda: decode_legacy(struct.unpack(">28H", RAW), len(VALUES)))
+report("single pass: raw bytes -> '>14f'", lambda: decode_single_pass(RAW))
@@ -0,0 +1,70 @@
+"""
+Benchmark of the line protocol serialization of a probe of power lines:
+the string building formatter used before against `LineWriter` writing into its reused buffer
+
+The heap is what counts on the board, a probe serialized without garbage spares a GC pass every few probes.
+Every number is a single `%` formatting call to bytes and every line a single write into the buffer, so on a host
+it's within a few tens of percent of the f-strings, for about a tenth of the allocations
+"""
+
+from bench_common import measure_alloc, measure_time
+
+from dts6619_emulator import DTS6619Emulator
+from dts6619_modbus import DTS6619
+from line_protocol import LineWriter
+
+FIELDS = DTS6619.PROFILE.metric_fields(DTS6619Emulator.DEFAULT_VALUES)
+TAGS = {'localtion': 'workshop', 'meter': 1}
+TIMESTAMP = 1700000000000000000
+LINES = sum(len(values) if isinstance(values, dict) else 1 for values in FIELDS.values())
+
+
+def make_base_line_legacy(name, tags):
+    tags_formatted = ','.join(['='.join(map(str, item)) for item in tags.items()])
+    line = name
+    if tags_formatted:
+        line += f',{tags_formatted}'
+    return line
+
+
+def format_lines_multi_legacy(name, tags, fields_data, timestamp):
+    """Copy of the formatter used before, with the timestamp of every line"""
+    base_line = make_base_line_legacy(name, tags)
+    lines = []
+    for field_name, tagged_values in fields_data.items():
+        if not isinstance(tagged_values, dict):
+            lines.append(base_line + f' {field_name}={tagged_values} {timestamp}')
+            continue
+        for tag, value in tagged_values.items():
+            lines.append(base_line + f',{tag} {field_name}={value} {timestamp}')
+    return '\n'.join(lines).encode()
+
+
+writer = LineWriter()
+series = writer.series('power', TAGS)
+
+
+def write_probe():
+    writer.clear()
+    writer.write_lines_multi('power', TAGS, FIELDS, TIMESTAMP)
+    return writer.getvalue()
+
+
+def write_probe_series():
+    writer.clear()
+    writer.write_series_multi(series, FIELDS, TIMESTAMP)
+    return writer.getvalue()
+
+
+assert len(format_lines_multi_legacy('power', TAGS, FIELDS, TIMESTAMP).split(b'\n')) == LINES
+assert len(bytes(write_probe()).split(b'\n')) == LINES + 1
+
+for name, fn in (
+    ("legacy f-strings", lambda: format_lines_multi_legacy('power', TAGS, FIELDS, TIMESTAMP)),
+    ("LineWriter", write_probe),
+    ("LineWriter Series", write_probe_series),
+):
+    us_per_probe = measure_time(fn, 1000)
+    print("{0:<20} {1:>10.0f} lines/s {2:>8.1f} bytes allocated/line".format(
+        name, LINES * 1000000 / us_per_probe, measure_alloc(fn, 100) / LINES,
+    ))
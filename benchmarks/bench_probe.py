@@ -0,0 +1,64 @@
+"""
+Benchmark of a whole probe against emulated DTS6619 meters on a fake 9600 baud line:
+reading the registers, decoding them and formatting the power lines,
+with every register read each probe or with the tiered DTS6619 schedule
+Also checks the values come out as the emulated meters report them
+"""
+
+import struct
+
+from bench_common import measure_alloc, measure_time
+
+from dts6619_emulator import FakeUart, DTS6619Emulator
+from dts6619_modbus import DTS6619
+from line_protocol import format_lines_multi
+from meter_bus import MeterBus
+from meter_profile import DEFAULT_MAX_GAP
+from modbus.modbus_rtu import RtuMaster
+
+
+def float32(value):
+    return struct.unpack('>f', struct.pack('>f', value))[0]
+
+
+def build_bus(meters, max_gap, tiered, realtime=True):
+    uart = FakeUart(baudrate=DTS6619.BAUDRATE, realtime=realtime)
+    bus = MeterBus(RtuMaster(uart, baudrate=DTS6619.BAUDRATE))
+    for address in range(1, meters + 1):
+        uart.attach(DTS6619Emulator(address))
+        meter = DTS6619(bus, address)
+        if tiered:
+            bus.add_meter(meter, meter.schedule(max_gap=max_gap))
+        else:
+            bus.add_meter(meter, ((0, meter.plan(max_gap=max_gap)),))
+    return uart, bus
+
+
+def probe(bus):
+    lines = []
+    for address, readings in bus.poll_blocking().items():
+        lines.append(format_lines_multi(
+            'power', {'localtion': 'bench', 'meter': address}, DTS6619.PROFILE.metric_fields(readings),
+        ))
+    return '\n'.join(lines)
+
+
+for meters in (1, 4):
+    for max_gap, tiered in ((0, False), (DEFAULT_MAX_GAP, False), (DEFAULT_MAX_GAP, True)):
+        uart, bus = build_bus(meters, max_gap, tiered)
+        readings = bus.poll_blocking()
+        assert sorted(readings) == list(range(1, meters + 1))
+        for name, value in DTS6619Emulator.DEFAULT_VALUES.items():
+            assert readings[1][name] == float32(value), name
+        assert len(probe(bus).split('\n')) == (18 if tiered else 20) * meters
+
+        uart.bytes_read = uart.bytes_written = 0
+        ms_per_probe = measure_time(lambda: probe(bus), 3) / 1000
+        print("{0} meter(s), max_gap={1:<3}{2:<7} {3:>8.1f} ms/probe {4:>5} bytes on the bus".format(
+            meters, max_gap, ' tiered' if tiered else '', ms_per_probe, (uart.bytes_read + uart.bytes_written) // 3,
+        ))
+
+        # Heap cost doesn't depend on the bus speed, measure it without waiting for the bytes
+        _, bus = build_bus(meters, max_gap, tiered, realtime=False)
+        bus.poll_blocking()
+        print("{0:>32} {1:>8.0f} bytes allocated/probe".format('', measure_alloc(lambda: probe(bus), 10)))
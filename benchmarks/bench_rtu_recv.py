@@ -0,0 +1,60 @@
+"""
+Benchmark of a full RtuMaster transaction against a serial stand-in that answers instantly
+Shows the time and heap cost of building the request, receiving and decoding the response,
+which should not grow with the response size apart from the tuple of decoded values itself
+"""
+
+import struct
+
+from bench_common import report
+
+import modbus.defines as cst
+from modbus import modbus_rtu, utils
+
+
+class CannedSerial:
+    """Answers every READ_INPUT_REGISTERS request with the same register value, without any bus timing"""
+
+    def __init__(self):
+        self._response = b""
+        self._position = 0
+        # Responses are built once, so the stand-in itself doesn't show up in the allocations
+        self._responses = {}
+
+    def write(self, request):
+        request = bytes(request)
+        if request not in self._responses:
+            slave, function_code, _, quantity = struct.unpack(">BBHH", request[:6])
+            data = struct.pack(">BBB", slave, function_code, quantity * 2) + b"\x12\x34" * quantity
+            self._responses[request] = data + struct.pack(">H", utils.calculate_crc(data))
+        self._response = self._responses[request]
+        self._position = 0
+        return len(request)
+
+    def any(self):
+        return len(self._response) - self._position
+
+    def read(self, length):
+        data = self._response[self._position:self._position + length]
+        self._position += len(data)
+        return data
+
+    def readinto(self, buf, length=None):
+        length = min(len(buf) if length is None else length, self.any())
+        buf[:length] = self._response[self._position:self._position + length]
+        self._position += length
+        return length
+
+
+master = modbus_rtu.RtuMaster(CannedSerial())
+
+for quantity in (2, 16, 56, 120):
+    report(
+        "execute READ_INPUT_REGISTERS x{0}".format(quantity),
+        lambda: master.execute(1, cst.READ_INPUT_REGISTERS, 0, quantity),
+    )
+    prepared = master.prepare(1, cst.READ_INPUT_REGISTERS, 0, quantity)
+    report(
+        "execute_prepared raw x{0}".format(quantity),
+        lambda: master.execute_prepared(prepared, raw=True),
+    )
@@ -0,0 +1,65 @@
+"""
+Checks the MQTT publisher against the stand-in broker of `mqtt_broker_emulator.py`:
+CONNECT with a persistent session, a QoS 1 PUBLISH lost with its connection sent again with DUP and the same
+packet id, a QoS 0 publish, PINGREQ, and the lines kept when the broker is gone
+
+    PYTHONPATH=. python benchmarks/check_mqtt.py
+"""
+
+try:
+    import uasyncio
+except ImportError:
+    # A host python, asyncio has everything uasyncio has
+    import sys
+    import asyncio
+    sys.modules['uasyncio'] = uasyncio = asyncio
+
+from mqtt import MqttClient, MqttPublisher
+from mqtt_broker_emulator import BrokerEmulator
+
+
+async def main():
+    broker = BrokerEmulator(drop_before_puback=1)
+    port = await broker.start()
+    client = MqttClient('127.0.0.1', port, client_id='powermon-check', username='user', password='secret', keepalive=2)
+    client.start()
+    await uasyncio.sleep(0.2)
+    assert broker.connects == [('powermon-check', False, 'user', 'secret', 2)], broker.connects
+
+    # The broker drops the first connection without the PUBACK, the publish goes again on a new one
+    publisher = MqttPublisher(client, 'powermon/check')
+    publisher.add_lines(memoryview(b'environment temperature=21.5'))
+    publisher.add_lines(b'environment temperature=21.75')
+    assert await publisher.export_async() is True
+    first, again = broker.published
+    assert first[0] == 1 and not first[3], first
+    assert again[0] == 2 and again[3] and again[4] == first[4], again
+    assert again[1:3] == ('powermon/check', 1) and again[5] == b'environment temperature=21.5\nenvironment temperature=21.75'
+    assert len(broker.connects) == 2
+    print("QoS 1 publish, lost with its connection, sent again with DUP: ok")
+
+    await client.publish('powermon/qos0', b'x', qos=0)
+    await uasyncio.sleep(0.1)
+    assert broker.published[-1] == (2, 'powermon/qos0', 0, False, None, b'x'), broker.published[-1]
+    print("QoS 0 publish: ok")
+
+    # keepalive // 2 seconds between the pings
+    await uasyncio.sleep(1.5)
+    assert broker.pings >= 1
+    print("keepalive ping: ok")
+
+    # Without a broker the lines stay for the next message
+    broker.stop()
+    await client.disconnect()
+    client._keepalive_task.cancel()
+    publisher.add_lines(b'environment temperature=22')
+    try:
+        await publisher.export_async()
+        raise AssertionError('published without a broker')
+    except OSError:
+        pass
+    assert publisher._batch == [b'environment temperature=22']
+    print("lines kept while the broker is away: ok")
+
+
+uasyncio.run(main())
@@ -0,0 +1,51 @@
+"""
+Gzip compression of the metrics request bodies, with MicroPython's `deflate` module or `zlib` on a host
+Line protocol repeats the measurement and the tags on every line, so even a small window squeezes it a lot
+"""
+
+try:
+    import deflate
+    import io
+except ImportError:
+    deflate = None
+    import zlib
+
+# 4KB window: a whole probe of lines fits, so a batch repeats the previous probe rather than a few lines back
+# Worth twice the ratio of a 1KB window on batches, see benchmarks/bench_compression.py
+DEFAULT_WINDOW_BITS = 12
+
+
+def gzip_parts(parts, window_bits=DEFAULT_WINDOW_BITS):
+    """
+    Compress the parts of a body joined by newlines, one part at a time,
+    so only the compressed body is ever kept in memory whole
+    """
+    if deflate is not None:
+        out = io.BytesIO()
+        # Strings are written as they are, MicroPython streams take anything with the buffer protocol
+        compressor = deflate.DeflateIO(out, deflate.GZIP, window_bits)
+        for i, part in enumerate(parts):
+            if i:
+                compressor.write(b'\n')
+            compressor.write(part)
+        # Writes the end of the gzip stream, `out` is left open
+        compressor.close()
+        return out.getvalue()
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + window_bits)
+    chunks = []
+    for i, part in enumerate(parts):
+        if i:
+            chunks.append(compressor.compress(b'\n'))
+        chunks.append(compressor.compress(part.encode() if isinstance(part, str) else part))
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def compression_available():
+    """MicroPython ports may have `deflate` built without compression, it only decompresses then"""
+    try:
+        gzip_parts((b'',))
+        return True
+    except Exception:
+        return False
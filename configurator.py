@@ -4,15 +4,41 @@ from machine import Pin
 
 _parameters = (
   ('deployment_location', '', 'default'),
+  ('metrics_tags', 'Extra tags of all the metrics, comma-separated key=value pairs', ''),
   ('send_metrics_interval', '', 30),
   ('watchdog_timeout', 'Restart after seconds if stuck', 60),
   ('meter_address', 'Address of the power meter', 1),
+  ('meter_addresses', 'Comma-separated addresses of all the meters on the bus, overrides meter_address', ''),
   ('meter_parity', 'Letters O=Odd, E=Even, N=None', 'O'),
+  ('meter_profile', 'Path of a JSON meter profile on the flash, empty for the built-in DTS6619', ''),
+  ('meter_slow_interval', 'Seconds between reads of the slowly changing energy counters', 300),
+  ('meter_max_gap', 'Unused registers a single read may span, 0 to read only adjacent ones', 16),
+  ('modbus_telemetry', 'Collect Modbus bus statistics, 1=on 0=off', 1),
+  ('modbus_attempts', 'Attempts per Modbus query, retrying CRC errors and timeouts', 3),
+  ('modbus_timeout_ms', 'Milliseconds to wait for a meter response in a single attempt', 1000),
+  ('modbus_deadline_ms', 'No new Modbus attempt past this many milliseconds since the query started', 2500),
+  ('modbus_tcp_port', 'Serve the latest meter readings over Modbus TCP on this port, 0=off, usually 502', 0),
   ('metrics_instance',
    'URL of influx-capable metrics target',
    'https://influx-prod-06-prod-us-central-0.grafana.net/api/v1/push/influx/write'),
   ('metrics_username', '', ''),
   ('metrics_password', '', ''),
+  ('metrics_batch_cycles', 'Probes per upload, 1 sends every probe with server-side timestamps', 1),
+  ('metrics_batch_bytes', 'Upload earlier once this many bytes of metrics are waiting', 16384),
+  ('metrics_queue_segments', '16KB files of metrics kept on the flash during outages, 0=off', 16),
+  ('metrics_replay_bytes', 'Bytes of queued metrics sent along every successful upload', 8192),
+  ('metrics_compress', 'Gzip the uploads, 1=on 0=off', 0),
+  ('metrics_file', 'Also keep the metrics in this file on the flash, empty=off', ''),
+  ('metrics_file_bytes', 'Size of the metrics file before it is moved to <file>.1', 65536),
+  ('metrics_udp_host', 'Also send the metrics as line protocol over UDP to this InfluxDB or Telegraf, empty=off', ''),
+  ('metrics_udp_port', '', 8089),
+  ('mqtt_host', 'Also publish the metrics to this MQTT broker, empty=off', ''),
+  ('mqtt_port', '', 1883),
+  ('mqtt_username', 'Empty for brokers without authentication', ''),
+  ('mqtt_password', '', ''),
+  ('mqtt_topic', 'Topic of the metrics, {location} is the deployment location', 'powermon/{location}'),
+  ('mqtt_qos', '0=fire and forget, 1=acknowledged by the broker', 1),
+  ('prometheus_metrics', 'Serve the latest readings for Prometheus on /metrics, 1=on 0=off', 1),
   ('wlan_ssid', 'Leave empty to reset the WiFi', ''),
   ('wlan_password', '', ''),
 )
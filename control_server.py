@@ -45,6 +45,11 @@ async def home(request):
     uptime_status = f"<tr><td>Uptime:</td><td>{time.time() - start_time} seconds</td></tr>"
     last_readings = f"<tr><td>Last readings:</td><td>{request.app.last_readings}</td></tr>"
     wlan_info     = f"<tr><td>WLAN IFCONFIG:</td><td>{request.app.wlan.ifconfig()}</td></tr>"
+    bus_telemetry = getattr(request.app, 'bus_telemetry', None)
+    modbus_stats  = ''.join([
+        f"<tr><td>Modbus slave {slave} function {function_code}:</td><td>{stats.fields()}</td></tr>"
+        for slave, function_code, stats in (bus_telemetry.items() if bus_telemetry is not None else ())
+    ])
 
     return ''.join([
         "<!DOCTYPE html><html>",
@@ -53,12 +58,22 @@ async def home(request):
         '<table class="table">',
         uptime_status,
         last_readings,
+        modbus_stats,
         wlan_info,
         home_links,
         "</table></body><html>",
     ]), {'Content-Type': 'text/html'}
 
 
+@app.route('/metrics')
+async def metrics(request):
+    # Rendered by the main loop at the end of every probe, scrapes cost nothing more than sending it
+    exposition = getattr(request.app, 'exposition', None)
+    if exposition is None:
+        return 'Prometheus metrics are disabled', 404
+    return exposition.body, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 async def machine_reset(delay=0.0):
     print(f"RESET requested, waiting for {delay}s first")
     await uasyncio.sleep(delay)
@@ -0,0 +1,141 @@
+"""
+DTS6619 meters emulated on a fake RS-485 line, to run the whole read -> decode -> line protocol path
+on a PC or the MicroPython unix port, without a real meter. Used by the benchmarks.
+
+    uart = FakeUart(baudrate=9600)
+    uart.attach(DTS6619Emulator(1, {'line_a_voltage': 231.5}))
+    bus = MeterBus(RtuMaster(uart, baudrate=9600))
+"""
+
+from modbus.exceptions import ModbusInvalidRequestError
+from modbus.modbus import Slave
+from modbus.modbus_rtu import RtuQuery
+from modbus.utils import ticks_us, ticks_diff
+
+from dts6619_modbus import DTS6619
+from register_bank import MeterRegisters
+
+
+class FakeUart:
+    """
+    Stand-in for `machine.UART` with emulated slaves on the other end of the line
+
+    Requests written by the master are handed to the slaves right away, and the response of the addressed one
+    becomes readable byte by byte, at the pace the baudrate allows, after the request itself went out
+    and the slave's response delay passed. With `realtime=False` responses are readable at once.
+    """
+
+    def __init__(self, baudrate=9600, realtime=True):
+        # start + 8 data + parity + stop bits
+        self.char_us = 11 * 1000000 // baudrate
+        self.realtime = realtime
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._slaves = []
+        self._response = b""
+        self._position = 0
+        self._sent_at = 0
+        self._first_byte_us = 0
+
+    def attach(self, slave):
+        """Connect an emulated slave to the line"""
+        self._slaves.append(slave)
+
+    def write(self, buf):
+        request = bytes(buf)
+        self.bytes_written += len(request)
+        self._sent_at = ticks_us()
+        self._response = b""
+        self._position = 0
+        for slave in self._slaves:
+            response = slave.handle_frame(request)
+            if response:
+                self._response = response
+                self._first_byte_us = len(request) * self.char_us + slave.response_delay_ms * 1000
+        return len(request)
+
+    def _arrived(self):
+        if not self.realtime:
+            return len(self._response)
+        elapsed_us = ticks_diff(ticks_us(), self._sent_at) - self._first_byte_us
+        if elapsed_us < 0:
+            return 0
+        return min(len(self._response), elapsed_us // self.char_us)
+
+    def any(self):
+        return self._arrived() - self._position
+
+    def read(self, length=-1):
+        available = self.any()
+        if length >= 0:
+            available = min(available, length)
+        if not available:
+            return None
+        data = self._response[self._position:self._position + available]
+        self._position += available
+        self.bytes_read += available
+        return data
+
+    def readinto(self, buf, length=-1):
+        available = min(self.any(), len(buf) if length < 0 else length)
+        if not available:
+            return None
+        buf[:available] = self._response[self._position:self._position + available]
+        self._position += available
+        self.bytes_read += available
+        return available
+
+
+class DTS6619Emulator:
+    """
+    DTS6619 meter on top of the modbus Slave, serving the register map of its profile
+    Registers not set explicitly hold `DEFAULT_VALUES`, unused registers between them read as zeros
+    Another meter model can be emulated by passing its profile along with the values
+    """
+
+    DEFAULT_VALUES = {
+        'line_a_voltage': 230.5, 'line_b_voltage': 229.75, 'line_c_voltage': 231.25,
+        'line_a_current': 1.5, 'line_b_current': 2.25, 'line_c_current': 0.125,
+        'sum_active_power': 812.0, 'line_a_active_power': 301.5,
+        'line_b_active_power': 250.25, 'line_c_active_power': 260.25,
+        'sum_reactive_power': -12.5, 'line_a_reactive_power': -4.0,
+        'line_b_reactive_power': -4.25, 'line_c_reactive_power': -4.25,
+        'line_a_power_factor': 0.98, 'line_b_power_factor': 0.97, 'line_c_power_factor': 0.99,
+        'frequency': 50.0,
+        'total_active_power': 12345.5,
+        'total_reactive_power': 321.25,
+    }
+
+    def __init__(self, address, values=None, response_delay_ms=20, profile=DTS6619.PROFILE):
+        self.address = address
+        self.response_delay_ms = response_delay_ms
+        self.profile = profile
+        self._slave = Slave(address)
+        self._registers = MeterRegisters(self._slave, profile)
+
+        self.values = dict(self.DEFAULT_VALUES) if profile is DTS6619.PROFILE else {}
+        self.values.update(values or {})
+        for name, value in self.values.items():
+            self.set_value(name, value)
+
+    def set_value(self, name, value):
+        """Change the value the meter reports for a register"""
+        self.values[name] = value
+        self._registers.set_value(name, value)
+
+    def handle_frame(self, request):
+        """Returns the response frame for the request, or None when the meter stays silent"""
+        query = RtuQuery()
+        try:
+            slave_id, request_pdu = query.parse_request(request)
+        except ModbusInvalidRequestError:
+            # A real slave ignores frames with a bad CRC
+            return None
+
+        if slave_id not in (self.address, 0):
+            return None
+
+        response_pdu = self._slave.handle_request(request_pdu, broadcast=slave_id == 0)
+        if not response_pdu:
+            return None
+        return query.build_response(response_pdu)
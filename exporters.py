@@ -0,0 +1,150 @@
+"""
+Export pipeline: the lines of a probe are serialized once and handed to every configured sink
+
+A sink is anything with these methods, each of them doing its own batching and queueing:
+- `add_lines(lines)`: the line protocol bytes of a probe, without the last newline
+- `count_cycle()`: a probe went by, returns whether the sink is due to export
+- `async export_async()`: export what's due. Returns None when nothing is due, True once delivered,
+  raises `Rejected` when the target got it but refused it, raises anything else when it failed
+- `network`: whether its failures tell that the network is down, see `ExportPipeline.network_failures`
+- `fields()`, optional: counters of its own, added to its status
+
+Every sink exports in its own task, so a slow or failing sink never holds the probes or the other sinks back.
+`AsyncMetricsSender` (Influx over HTTP), `UdpMetricsSender`, `MqttPublisher` and `FileSink` are sinks
+"""
+
+import os
+
+import uasyncio
+
+
+class Rejected(Exception):
+    """
+    The target of a sink is reachable but refused the lines, e.g. with wrong credentials
+    Counted apart from the failures, rebooting the board won't get the lines through
+    """
+
+
+class _SinkRunner:
+    """A sink with its export task and its counters"""
+
+    def __init__(self, name, sink):
+        self.name = name
+        self.sink = sink
+        self.task = None
+        # Consecutive failures, reset once the target is reached
+        self.failures = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.last_error = None
+
+    async def run(self):
+        try:
+            result = await self.sink.export_async()
+        except Rejected as e:
+            # The network got through at least
+            self.failures = 0
+            self.rejected += 1
+            self.last_error = str(e)
+            print(f'{self.name} refused the export: {e}')
+            return
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f'Failed to export to {self.name}: {e}')
+            return
+        if result:
+            self.failures = 0
+            self.delivered += 1
+
+
+class ExportPipeline:
+    """Fans the lines of every probe out to the sinks"""
+
+    def __init__(self):
+        self._runners = []
+
+    def __len__(self):
+        return len(self._runners)
+
+    def add_sink(self, name, sink):
+        self._runners.append(_SinkRunner(name, sink))
+
+    def export(self, lines):
+        """Hand the lines of a probe to every sink and start the exports that are due, returns right away"""
+        # A single copy shared by all the sinks, `lines` is usually the buffer of a `LineWriter`
+        lines = bytes(lines)
+        for runner in self._runners:
+            if lines:
+                runner.sink.add_lines(lines)
+            if runner.task is None or runner.task.done():
+                runner.task = uasyncio.create_task(runner.run())
+            else:
+                # The previous export is still going, the lines wait for the next one
+                runner.sink.count_cycle()
+
+    def network_failures(self):
+        """Consecutive failures of the network sinks, the best of them: only counts when none of them gets through"""
+        failures = [runner.failures for runner in self._runners if runner.sink.network]
+        return min(failures) if failures else 0
+
+    def status(self):
+        """name -> counters of the sinks, for the control server and the metrics"""
+        status = {}
+        for runner in self._runners:
+            status[runner.name] = {
+                'delivered': runner.delivered, 'failures': runner.failures, 'rejected': runner.rejected,
+                'last_error': runner.last_error,
+            }
+            if hasattr(runner.sink, 'fields'):
+                status[runner.name].update(runner.sink.fields())
+        return status
+
+
+class FileSink:
+    """
+    Appends the lines to a file on the flash, so the data survives when nothing else is reachable
+    Lines are kept in memory for `batch_cycles` probes to spare the flash from small writes.
+    Once the file is over `max_bytes` it's moved to `<path>.1`, replacing the previous one
+    """
+
+    network = False
+
+    def __init__(self, path, max_bytes=65536, batch_cycles=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_cycles = batch_cycles
+        self._batch = []
+        self._batch_cycle = 0
+        try:
+            self._length = os.stat(path)[6]
+        except OSError:
+            self._length = 0
+
+    def add_lines(self, lines):
+        self._batch.append(bytes(lines))
+
+    def count_cycle(self):
+        self._batch_cycle += 1
+        return self._batch_cycle >= self.batch_cycles
+
+    def _rotate(self):
+        try:
+            os.remove(self.path + '.1')
+        except OSError:
+            pass
+        os.rename(self.path, self.path + '.1')
+        self._length = 0
+
+    async def export_async(self):
+        if not self.count_cycle() or not self._batch:
+            return None
+        batch, self._batch, self._batch_cycle = self._batch, [], 0
+        if self._length >= self.max_bytes:
+            self._rotate()
+        with open(self.path, 'ab') as f:
+            for lines in batch:
+                f.write(lines)
+                f.write(b'\n')
+                self._length += len(lines) + 1
+        return True
@@ -0,0 +1,255 @@
+"""
+Influx line protocol formatting, see https://docs.influxdata.com/influxdb/cloud/reference/syntax/line-protocol/
+Kept apart from the transport so it can be reused by any sender, and run on a host
+
+`LineWriter` serializes straight into a reusable bytearray, `format_line` and `format_lines_multi`
+are the string returning shortcuts on top of it.
+A `Series` is a measurement with its tags compiled into the ready-made start of its lines, the set of series
+doesn't change from one probe to the next, so only the values and the timestamps are written every time
+"""
+
+# Significant digits of the floats written, enough for any 32-bit register: the energy counters are scaled
+# uint32 registers, e.g. 1234567.89 kWh, which would lose their last digits with the 7 of a float32.
+# Float32 registers come out with a few digits of noise, like 230.1000061, they're the same float32 still
+FLOAT_DIGITS = 10
+_FLOAT_FORMAT = b'%%.%dg' % FLOAT_DIGITS
+
+
+def _escape(value, special):
+    value = str(value)
+    for character in special:
+        if character in value:
+            value = value.replace(character, '\\' + character)
+    return value
+
+
+def escape_measurement(name):
+    return _escape(name, '\\, ')
+
+
+def escape_key(key):
+    """Escaping of the tag keys, tag values and field keys"""
+    return _escape(key, '\\,= ')
+
+
+def format_line_value(value):
+    """Format a field value, numbers are sent as floats whatever their python type"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return str(value)
+
+
+def series_key(name, tags):
+    """The `name,tag=value,...` start of the lines of a series, escaped and encoded"""
+    key = escape_measurement(name)
+    for tag, value in tags.items():
+        key += ',' + escape_key(tag) + '=' + escape_key(value)
+    return key.encode()
+
+
+class Series:
+    """
+    A measurement with its set of tags, the start of its lines built once
+    Every field gets a ready-made `name,tags[,tag] field=` prefix too, so writing a line of the series
+    is down to a prefix, a value and a timestamp
+    """
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.key = series_key(name, tags)
+        # field name -> tag of the value (None for untagged ones) -> prefix of the line
+        self._field_prefixes = {}
+
+    def field_prefixes(self, field_name):
+        """tag of the value -> prefix, of the prefixes of `field_name` built so far"""
+        try:
+            return self._field_prefixes[field_name]
+        except KeyError:
+            prefixes = self._field_prefixes[field_name] = {}
+            return prefixes
+
+    def field_prefix(self, field_name, tag=None):
+        """Prefix of the lines of `field_name`, tags of the values are written as they are, e.g. 'line=A'"""
+        try:
+            return self._field_prefixes[field_name][tag]
+        except KeyError:
+            pass
+        prefix = self.key
+        if tag is not None:
+            prefix += b',' + str(tag).encode()
+        prefix += b' ' + escape_key(field_name).encode() + b'='
+        self.field_prefixes(field_name)[tag] = prefix
+        return prefix
+
+
+class LineWriter:
+    """
+    Writes lines straight into a bytearray reused from one batch to the next, growing it when needed
+    Series and field keys are escaped and encoded once and cached, a number costs a single bytes formatting,
+    so serializing a probe doesn't leave a trail of temporary strings on the heap
+    """
+
+    def __init__(self, size=2048, max_series=64):
+        self.buffer = bytearray(size)
+        self.length = 0
+        # field key -> escaped and encoded key
+        self._keys = {}
+        # (name, tags items) -> Series, up to `max_series` of them
+        self._series = {}
+        self.max_series = max_series
+        self._timestamp = None
+        self._timestamp_encoded = b'\n'
+
+    def __len__(self):
+        return self.length
+
+    def clear(self):
+        self.length = 0
+
+    def getvalue(self):
+        """The lines written so far, a view valid until the writer is cleared or written to again"""
+        return memoryview(self.buffer)[:self.length]
+
+    def series(self, name, tags):
+        """
+        The Series of `name` and `tags`, interned so the lines written with the same ones share its prefixes
+        Hold on to it to skip the lookup altogether, see `write_series_line` and `write_series_multi`
+        """
+        key = (name, tuple(tags.items()))
+        try:
+            return self._series[key]
+        except KeyError:
+            if len(self._series) >= self.max_series:
+                # Tags changing from line to line would grow it forever, start over
+                self._series.clear()
+            series = self._series[key] = Series(name, tags)
+            return series
+
+    def _grow(self, length):
+        grown = bytearray(max(len(self.buffer) * 2, length))
+        grown[:self.length] = memoryview(self.buffer)[:self.length]
+        self.buffer = grown
+
+    def _write(self, data):
+        start = self.length
+        end = start + len(data)
+        if end > len(self.buffer):
+            self._grow(end)
+        self.buffer[start:end] = data
+        self.length = end
+
+    def _encode_key(self, key):
+        """The escaped and encoded `key=` of a field"""
+        try:
+            return self._keys[key]
+        except KeyError:
+            encoded = self._keys[key] = escape_key(key).encode() + b'='
+            return encoded
+
+    def _format_value(self, value):
+        """The bytes of a field value, None for the ones Influx can't store"""
+        if type(value) is float:
+            # Influx has no way to write NaN or infinity, such a field is left out. Both give NaN when subtracted
+            if value - value != 0:
+                return None
+            # One formatting call straight to bytes, way faster than anything done digit by digit in python
+            return _FLOAT_FORMAT % value
+        if type(value) is int:
+            return b'%d' % value
+        return format_line_value(value).encode()
+
+    def _line_end(self, timestamp):
+        """` <timestamp>\n`, all the lines of a probe usually share the timestamp so it's only formatted once"""
+        if timestamp != self._timestamp:
+            self._timestamp = timestamp
+            self._timestamp_encoded = b'\n' if timestamp is None else b' %d\n' % timestamp
+        return self._timestamp_encoded
+
+    def write_line(self, name, tags, fields, timestamp=None):
+        """Write a single line with all the fields, see `MetricsSender.send_metric`"""
+        self.write_series_line(self.series(name, tags), fields, timestamp)
+
+    def write_series_line(self, series, fields, timestamp=None):
+        start = self.length
+        self._write(series.key)
+        separator = b' '
+        for key, value in fields.items():
+            value = self._format_value(value)
+            if value is None:
+                continue
+            self._write(separator)
+            separator = b','
+            self._write(self._encode_key(key))
+            self._write(value)
+        if separator == b' ':
+            # No fields, no line
+            self.length = start
+            return
+        self._write(self._line_end(timestamp))
+
+    def write_lines_multi(self, name, tags, fields_data, timestamp=None):
+        """
+        Write a line per field and per tagged value, see `MetricsSender.format_metrics_multi`
+        `timestamp` goes to every line, unless a value comes with its own as a `(value, timestamp)` tuple
+        Tags of the values are written as they are, e.g. 'line=A'
+        """
+        self.write_series_multi(self.series(name, tags), fields_data, timestamp)
+
+    def write_series_multi(self, series, fields_data, timestamp=None):
+        line_end = self._line_end(timestamp)
+        for field_name, tagged_values in fields_data.items():
+            if not isinstance(tagged_values, dict):  # We can have a single value here
+                self._write_field_line(series.field_prefix(field_name), tagged_values, line_end)
+                continue
+            prefixes = series.field_prefixes(field_name)
+            for tag, value in tagged_values.items():
+                prefix = prefixes.get(tag) or series.field_prefix(field_name, tag)
+                if type(value) is not float or value - value != 0:
+                    # Anything but a plain float, see `_write_field_line`
+                    self._write_field_line(prefix, value, line_end)
+                    continue
+                # The bulk of a probe, a single short lived line beats three separate writes
+                line = prefix + _FLOAT_FORMAT % value + line_end
+                start = self.length
+                end = start + len(line)
+                if end > len(self.buffer):
+                    self._grow(end)
+                self.buffer[start:end] = line
+                self.length = end
+
+    def _write_field_line(self, prefix, value, line_end):
+        if type(value) is tuple:
+            value, timestamp = value
+            line_end = b' %d\n' % timestamp
+        value = self._format_value(value)
+        if value is not None:
+            self._write(prefix + value + line_end)
+
+
+# Shared by the string returning shortcuts
+_writer = LineWriter(512)
+
+
+def _pop_lines():
+    """The lines written by `_writer` as a string, without the last newline"""
+    lines = bytes(memoryview(_writer.buffer)[:max(_writer.length - 1, 0)]).decode()
+    _writer.clear()
+    return lines
+
+
+def format_line(name, tags, fields, timestamp=None):
+    """Format a single line with all the fields, see `MetricsSender.send_metric`"""
+    _writer.write_line(name, tags, fields, timestamp)
+    return _pop_lines()
+
+
+def format_lines_multi(name, tags, fields_data, timestamp=None):
+    """
+    Format a line per field and per tagged value, see `MetricsSender.format_metrics_multi`
+    `timestamp` goes to every line, unless a value comes with its own as a `(value, timestamp)` tuple
+    """
+    _writer.write_lines_multi(name, tags, fields_data, timestamp)
+    return _pop_lines()
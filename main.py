@@ -7,13 +7,26 @@ import gc
 from watchdog_timer import WatchdogTimer
 
 from dts6619_modbus import DTS6619
+from meter_profile import Meter, load_profile
+from meter_bus import MeterBus
+from register_bank import RegisterBank
+from modbus.modbus_tcp import TcpServer
+from modbus.telemetry import BusTelemetry
 from dht import DHT22
 from mq135 import MQ135
 
 import network
-from net_metrics import MetricsSender, connect
-
-from control_server import app
+import ubinascii
+import ntptime
+from net_metrics import UdpMetricsSender, connect
+from net_metrics_async import AsyncMetricsSender
+from exporters import ExportPipeline, FileSink
+from mqtt import MqttClient, MqttPublisher
+from metrics_queue import FlashQueue
+from line_protocol import LineWriter
+from prometheus import Exposition
+
+from control_server import app, start_time
 
 from configurator import get_configurator
 
@@ -56,6 +69,28 @@ if config.get('wlan_ssid', '') == '' or app.wlan is None:
     ap.active(True)
 
 
+# Lines that may reach their target late are timestamped on the board, otherwise the server stamps them
+# with the time they arrive at. Influx lines can always be late: batched, queued on the flash during an outage
+# or waiting for the send in flight. So can the ones kept in a file or waiting for an MQTT reconnect
+timestamped = (
+    config.get('metrics_username', '') != '' or config.get('metrics_file', '') != '' or config.get('mqtt_host', '') != ''
+)
+
+
+def sync_clock():
+    """Set the clock over NTP, returns whether it's right. The RTC starts in 2021 on every boot"""
+    if not app.wlan.isconnected():
+        return False
+    try:
+        ntptime.settime()
+        return True
+    except Exception as e:
+        print(f"Failed to set the time over NTP: {e}")
+        return False
+
+
+clock_synced = timestamped and sync_clock()
+
 watchdog.feed()
 
 parity_map = {'O': 1, 'E': 0, 'N': None}
@@ -65,6 +100,32 @@ last_readings = {}
 
 app.last_readings = last_readings
 
+# Modbus transactions statistics, published along the power data and shown by the control server
+bus_telemetry = None
+if config.get('modbus_telemetry', 1):
+    bus_telemetry = BusTelemetry()
+    bus_telemetry.install()
+
+app.bus_telemetry = bus_telemetry
+
+
+def meter_addresses():
+    """All the meters sharing the RS-485 line, `meter_addresses` takes over `meter_address` when set"""
+    addresses = config.get('meter_addresses', '')
+    if addresses:
+        return [int(address) for address in addresses.split(',')]
+    return [config.get('meter_address')]
+
+
+def metrics_tags():
+    """Custom tags of all the metrics, `metrics_tags` is a comma-separated list of `key=value`"""
+    tags = {}
+    for tag in config.get('metrics_tags', '').split(','):
+        if '=' in tag:
+            key, value = tag.split('=', 1)
+            tags[key.strip()] = value.strip()
+    return tags
+
 
 async def main(
         watchdog,  # This is the only required argument - we gotta feed it
@@ -74,17 +135,58 @@ async def main(
     ):
     """
     Main probing loop
-    Yes it blocks in a multiple places, which can make server slower or not that reliable
+    Power meter reads yield to the HTTP server while waiting for the bus,
+    but the rest still blocks in a multiple places, which can make server slower or not that reliable
     Such is life right now though, so it'll have to stay that way /shrug
     """
-    if config.get('metrics_username', None) is None:
-        print("Metrics target is not configured, metrics will be collected but won't be sent")
-        metrics_sender = None
-    else:
-        metrics_sender = MetricsSender(
+    global clock_synced
+
+    # Every sink gets the same lines, each of them sends them its own way and pace
+    exporters = ExportPipeline()
+    if config.get('metrics_username', ''):
+        exporters.add_sink('influx', AsyncMetricsSender(
             config.get('metrics_instance'),
             config.get('metrics_username'), config.get('metrics_password'),
+            batch_cycles=config.get('metrics_batch_cycles', 1),
+            batch_bytes=config.get('metrics_batch_bytes', 16384),
+            # Whatever can't be sent during an outage waits on the flash, instead of leaving a hole in the data
+            queue=FlashQueue(max_segments=config.get('metrics_queue_segments', 16))
+            if config.get('metrics_queue_segments', 16) else None,
+            compress=config.get('metrics_compress', 0),
+            replay_bytes=config.get('metrics_replay_bytes', 8192),
+        ))
+    if config.get('metrics_file', ''):
+        exporters.add_sink('file', FileSink(
+            config.get('metrics_file'), max_bytes=config.get('metrics_file_bytes', 65536),
+        ))
+    if config.get('metrics_udp_host', ''):
+        # Fire and forget, cheap enough for probing every second
+        exporters.add_sink('udp', UdpMetricsSender(
+            config.get('metrics_udp_host'), port=config.get('metrics_udp_port', 8089),
+        ))
+    if config.get('mqtt_host', ''):
+        # A persistent session on a local broker, no TLS handshake per send
+        mqtt_client = MqttClient(
+            config.get('mqtt_host'), port=config.get('mqtt_port', 1883),
+            client_id='powermon-' + ubinascii.hexlify(machine.unique_id()).decode(),
+            username=config.get('mqtt_username', '') or None, password=config.get('mqtt_password', '') or None,
         )
+        mqtt_client.start()
+        exporters.add_sink('mqtt', MqttPublisher(
+            mqtt_client, config.get('mqtt_topic', 'powermon/{location}').format(location=deployment_location),
+            qos=config.get('mqtt_qos', 1),
+        ))
+    if not len(exporters):
+        print("No metrics target is configured, metrics will be collected but won't be sent")
+    # Every probe is serialized into the same buffer
+    line_writer = LineWriter()
+    # Tags of all the series, built into their line prefixes once
+    base_tags = {'localtion': deployment_location,}
+    base_tags.update(metrics_tags())
+    env_series = line_writer.series('environment', base_tags)
+    # Same metrics for Prometheus to scrape from `/metrics`, rendered once a probe is over
+    exposition = Exposition() if config.get('prometheus_metrics', 1) else None
+    app.exposition = exposition
 
     # Temp & humidity
     # yellow - GP22 - DHT22
@@ -102,16 +204,69 @@ async def main(
     # white - GP27 - MQ-135
     mq135 = MQ135(27)
 
-    # Power meter
+    # Power meters, all sharing the same RS-485 line and of the same model
+    # The profile is compiled into read plans and decoders once here, probes only run them
+    meter_profile = DTS6619.PROFILE
     try:
-        power_meter = DTS6619((0, 16, 17, parity_map[config.get('meter_parity')]), config.get('meter_address'))
-    except KeyError:
-        power_meter = None
-
-    send_failures = 0
+        if config.get('meter_profile', ''):
+            meter_profile = load_profile(config.get('meter_profile'))
+        meter_bus = MeterBus.from_uart_data(
+            (0, 16, 17, parity_map[config.get('meter_parity')]), baudrate=meter_profile.baudrate,
+        )
+        # A garbled or missed response is retried right away instead of losing the meter for the whole interval
+        meter_bus.master.set_retry_policy(
+            max_attempts=config.get('modbus_attempts', 3),
+            attempt_timeout_ms=config.get('modbus_timeout_ms', 1000),
+            deadline_ms=config.get('modbus_deadline_ms', 2500),
+            backoff_ms=10,
+        )
+        for address in meter_addresses():
+            power_meter = Meter(meter_bus, address, meter_profile)
+            # All the registers are merged into as few transactions as possible once, then re-used every probe
+            # Energy counters change slowly, so they're read less often than the instantaneous values if the profile
+            # has an `energy` group
+            meter_bus.add_meter(power_meter, power_meter.schedule(
+                {'energy': config.get('meter_slow_interval', 300)}, max_gap=config.get('meter_max_gap', 16),
+            ))
+    except (KeyError, ValueError, OSError) as e:
+        # Wrong parity, a missing or broken profile, a group naming an unknown register...
+        # The meters are left out rather than the whole probing loop, the environment data still goes out
+        print(f"Failed to set up the power meters, probing without them: {e}")
+        meter_bus = None
+
+    # The latest readings served over Modbus TCP, clients never add any traffic to the RS-485 line
+    register_bank = None
+    if meter_bus is not None and config.get('modbus_tcp_port', 0):
+        register_bank = RegisterBank()
+        for address in meter_bus.addresses:
+            register_bank.add_meter(address, meter_profile)
+        await TcpServer(register_bank, port=config.get('modbus_tcp_port')).start()
+
+    # Meters are only tagged when there are several, so single-meter sites keep their series
+    meter_series = {}
+    # meter address -> last value of every register read so far, what Prometheus is served
+    latest_readings = {}
+    if meter_bus is not None:
+        tag_meter = len(meter_bus.addresses) > 1
+        for address in meter_bus.addresses:
+            tags = dict(base_tags)
+            if tag_meter:
+                tags['meter'] = address
+            meter_series[address] = line_writer.series(meter_profile.measurement, tags)
+            latest_readings[address] = {}
+    # (slave, function code) -> Series, they show up as the bus sees traffic
+    telemetry_series = {}
+
+    # Consecutive probes missing some of the data, a sensor or a meter being away has nothing to do with the network
+    incomplete_probes = 0
 
     while True:
         probe_start_time = time.time()
+        # All the lines of a probe share the timestamp of its start, in ns
+        # Until the clock is right, the lines are better off stamped by the server than in 2021
+        if timestamped and not clock_synced:
+            clock_synced = sync_clock()
+        timestamp = time.time_ns() if clock_synced else None
 
         led.toggle()
         watchdog.feed()
@@ -153,104 +308,91 @@ async def main(
         watchdog.feed()
 
         power_data = {}
-        try:
-            power_data.update(power_meter.read_multiple('line_a_voltage', 3))
-            power_data.update(power_meter.read_multiple('line_a_current', 3))
-            power_data.update(power_meter.read_multiple('sum_active_power', 8))
-            power_data.update(power_meter.read_multiple('line_a_power_factor', 3))
-            power_data.update({
-                'frequency': power_meter.read('frequency'),
-                'total_active_power': power_meter.read('total_active_power'),
-                'total_reactive_power': power_meter.read('total_reactive_power'),
-            })
-        except Exception as e:
-            print(f'exception collecting power data: {e}', power_data)
-            print(e)
+        # Without meters, as they failed to set up, there's nothing to poll
+        if meter_bus is not None:
+            try:
+                # Readings come out by meter address, leave at least half of the interval for everything else
+                power_data.update(await meter_bus.poll(budget_ms=send_interval * 500))
+                if register_bank is not None:
+                    for address, readings in power_data.items():
+                        register_bank.update(address, readings)
+            except Exception as e:
+                print(f'exception collecting power data: {e}', power_data)
+                print(e)
 
         led.toggle()
         watchdog.feed()
 
         gc.collect()
+        line_writer.clear()
         last_readings['env_data'] = env_data
         if env_data:
-            print("About to send env_data:", env_data)
-            try:
-                metrics_sender.send_metric(
-                    'environment',
-                    {'localtion': deployment_location,},
-                    env_data,
-                )
-                last_readings['env_data_sent'] = True
-                send_failures = 0
-            except Exception as e:
-                send_failures += 1
-                last_readings['env_data_exc'] = str(e)
-                print(f'No can send env data: {e}')
-
-            led.toggle()
-            watchdog.feed()
+            print("Queueing env_data:", env_data)
+            line_writer.write_series_line(env_series, env_data, timestamp)
+            if exposition is not None:
+                exposition.add(env_series.name, env_series.tags, env_data)
         else:
-            send_failures += 1
+            incomplete_probes += 1
             print("No environment data to send!")
-        
+
         last_readings['power_data'] = power_data
         if power_data:
-            print("About to send power_data:", power_data)
-            try:
-                metrics_sender.send_metrics_multi(
-                    'power',
-                    {'localtion': deployment_location,},
-                    {
-                        "voltage": {
-                            "line=A": power_data['line_a_voltage'],
-                            "line=B": power_data['line_b_voltage'],
-                            "line=C": power_data['line_c_voltage'],
-                        },
-                        "current": {
-                            "line=A": power_data['line_a_current'],
-                            "line=B": power_data['line_b_current'],
-                            "line=C": power_data['line_c_current'],
-                        },
-                        "watts_active": {
-                            "line=A": power_data['line_a_active_power'],
-                            "line=B": power_data['line_b_active_power'],
-                            "line=C": power_data['line_c_active_power'],
-                            "line=ALL": power_data['sum_active_power'],
-                        },
-                        "watts_reactive": {
-                            "line=A": power_data['line_a_reactive_power'],
-                            "line=B": power_data['line_b_reactive_power'],
-                            "line=C": power_data['line_c_reactive_power'],
-                            "line=ALL": power_data['sum_reactive_power'],
-                        },
-                        "factor": {
-                            "line=A": power_data['line_a_power_factor'],
-                            "line=B": power_data['line_b_power_factor'],
-                            "line=C": power_data['line_c_power_factor'],
-                        },
-                        "frequency": power_data['frequency'],
-                        "watts_total": {
-                            "type=active": power_data['total_active_power'],
-                            "type=reactive": power_data['total_reactive_power'],
-                        },
-                    },
-                )
-                last_readings['power_data_sent'] = True
-                send_failures = 0
-            except Exception as e:
-                send_failures += 1
-                last_readings['power_data_exc'] = str(e)
-                print(f'No can send power data: {e}')
-
-            led.toggle()
-            watchdog.feed()
-        else:
-            send_failures += 1
+            print("Queueing power_data:", power_data)
+            for address, readings in power_data.items():
+                line_writer.write_series_multi(meter_series[address], meter_profile.metric_fields(readings), timestamp)
+        elif meter_bus is not None:
+            incomplete_probes += 1
             print("No power data to send!")
 
+        if exposition is not None:
+            # A scrape gets every register, not just the ones of the last probe: the energy ones are only read every
+            # few probes, and a meter missing a probe would have its series go stale and break their rate()
+            for address, readings in power_data.items():
+                latest_readings[address].update(readings)
+            for address, readings in latest_readings.items():
+                if readings:
+                    series = meter_series[address]
+                    exposition.add_multi(series.name, series.tags, meter_profile.metric_fields(readings))
+
+        # Bus statistics go out whatever the meters said, they're what tells a dead bus from a dead meter
+        if bus_telemetry is not None:
+            for slave, function_code, stats in bus_telemetry.items():
+                series = telemetry_series.get((slave, function_code))
+                if series is None:
+                    series = telemetry_series[(slave, function_code)] = line_writer.series(
+                        'modbus', dict(base_tags, slave=slave, function=function_code),
+                    )
+                fields = stats.fields()
+                line_writer.write_series_line(series, fields, timestamp)
+                if exposition is not None:
+                    exposition.add(series.name, series.tags, fields)
+
+        if env_data and power_data:
+            incomplete_probes = 0
+
+        # Sinks export in the background, without a sink the board may well be scraped only
+        # Without the newline ending the last line, batches are joined by newlines
+        exporters.export(line_writer.getvalue()[:-1])
+        last_readings['exports'] = exporters.status()
+
+        if exposition is not None:
+            exposition.add('device', base_tags, {
+                'uptime_seconds': time.time() - start_time,
+                'incomplete_probes': incomplete_probes,
+                'free_memory_bytes': gc.mem_free(),
+            })
+            for name, status in last_readings['exports'].items():
+                # The counters only, `add` leaves the last error out as Prometheus has no strings
+                exposition.add('export', dict(base_tags, sink=name), status)
+            exposition.render()
+
+        led.toggle()
+        watchdog.feed()
+
         # Don't let send failures happen more than failures_limit consecutively
         # But only do it if WiFi connection is setup, otherwise just let it run
-        if config.get('wlan_ssid', '') != '' and send_failures >= failures_limit:
+        # None of the network sinks getting through for that long is the WiFi being stuck, most likely
+        if config.get('wlan_ssid', '') != '' and exporters.network_failures() >= failures_limit:
             print("Experienced 5 data send failures, resetting")
             machine.reset()
 
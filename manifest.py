@@ -4,11 +4,21 @@ include("./manifest_basic.py")
 package("modbus")
 
 module("logging.py")
+module("meter_bus.py")
+module("meter_profile.py")
+module("register_bank.py")
 module("dts6619_modbus.py")
 # Not used currently due to difficulties understanding the code/needing to make it async
 # module("MQ7.py")
 module("mq135.py")
+module("compression.py")
+module("line_protocol.py")
+module("prometheus.py")
+module("metrics_queue.py")
 module("net_metrics.py")
+module("net_metrics_async.py")
+module("exporters.py")
+module("mqtt.py")
 module("watchdog_timer.py")
 module("configurator.py")
 
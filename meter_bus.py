@@ -0,0 +1,145 @@
+import logging
+
+from modbus.utils import ticks_ms, ticks_us, ticks_diff
+
+# A group is due a bit before its interval is over, so probes jitter doesn't push it to the next probe
+DUE_SLACK_MS = 500
+
+
+class MeterBus:
+    """
+    A single RS-485 line: one UART and one Modbus master shared by all the meters on it.
+    Meters are polled round-robin, so a slow or dead meter can't starve the others:
+    - every poll starts from the meter after the one that was served first last time
+    - a poll stops before the meter that wouldn't fit before the deadline, it'll go first next time
+    - a meter failing in a row is skipped for exponentially more polls, up to `max_backoff` of them
+    Each meter has a schedule: register groups with their own read plan and polling interval,
+    so every poll only reads the groups that are due
+    """
+
+    def __init__(self, master, name='bus', max_backoff=8):
+        self.master = master
+        self.name = name
+        self.max_backoff = max_backoff
+        self._logger = logging.getLogger(f"meter_bus.{name}")
+        # [meter, groups, consecutive failures, polls left to skip, last poll duration in us]
+        # with groups being [interval in ms, last read ticks_ms or None, plan]
+        self._meters = []
+        self._next = 0
+
+    @classmethod
+    def from_uart_data(cls, uart_data, baudrate=9600, **kwargs):
+        """Create the UART from the usual `(uart_id, tx_pin, rx_pin, parity)` tuple and the master over it"""
+        import machine
+        from modbus import modbus_rtu_async
+
+        uart = machine.UART(
+            uart_data[0], tx=machine.Pin(uart_data[1]), rx=machine.Pin(uart_data[2]),
+            baudrate=baudrate, bits=8, parity=uart_data[3], stop=1,
+            timeout=1000, timeout_char=100,
+        )
+        return cls(
+            modbus_rtu_async.AsyncRtuMaster(uart, baudrate=baudrate),
+            name='uart_' + '_'.join(map(str, uart_data)),
+            **kwargs
+        )
+
+    def add_meter(self, meter, schedule):
+        """
+        Register a meter sitting on this bus together with its schedule:
+        `(interval in seconds, read plan)` pairs, 0 meaning the plan is read on every poll
+        """
+        self._meters.append([meter, [[interval * 1000, None, plan] for interval, plan in schedule], 0, 0, 0])
+
+    @property
+    def addresses(self):
+        return [meter.address for meter, _, _, _, _ in self._meters]
+
+    def _schedule(self, budget_ms):
+        """Yields the meters to poll now in round-robin order, until the budget is spent"""
+        started_at = ticks_us()
+        count = len(self._meters)
+        first = self._next
+        for i in range(count):
+            index = (first + i) % count
+            entry = self._meters[index]
+            if entry[3] > 0:
+                entry[3] -= 1
+                continue
+
+            elapsed_us = ticks_diff(ticks_us(), started_at)
+            if budget_ms is not None and elapsed_us + entry[4] > budget_ms * 1000:
+                # Doesn't fit anymore, this one will be served first next time
+                self._next = index
+                return
+            yield entry
+
+        self._next = (first + 1) % count if count else 0
+
+    def _account(self, entry, started_at, failed):
+        entry[4] = ticks_diff(ticks_us(), started_at)
+        if not failed:
+            entry[2] = entry[3] = 0
+            return
+
+        entry[2] += 1
+        entry[3] = min((1 << (entry[2] - 1)) - 1, self.max_backoff)
+        self._logger.warning("Meter %s failed %d times in a row, skipping %d polls", entry[0].address, entry[2], entry[3])
+
+    def _due(self, groups):
+        """Yields the groups due now"""
+        now = ticks_ms()
+        for group in groups:
+            if group[1] is None or ticks_diff(now, group[1]) >= group[0] - DUE_SLACK_MS:
+                yield group
+
+    async def poll(self, budget_ms=None):
+        """
+        Read the due groups of every meter once, without spending more than `budget_ms` on the bus
+        Returns `{meter address: readings}`, meters that failed or were skipped are missing
+        """
+        readings = {}
+        for entry in self._schedule(budget_ms):
+            meter = entry[0]
+            started_at = ticks_us()
+            meter_readings = {}
+            failures = 0
+            for group in self._due(entry[1]):
+                try:
+                    meter_readings.update(await meter.read_planned_async(group[2]))
+                except Exception as e:
+                    failures += 1
+                    self._logger.error("Failed to read meter %s: %s", meter.address, e)
+                else:
+                    group[1] = ticks_ms()
+            self._collect(readings, entry, started_at, meter_readings, failures)
+        return readings
+
+    def _collect(self, readings, entry, started_at, meter_readings, failures):
+        """
+        Keep the groups that were read, a failed group is simply due again next poll
+        The meter only counts as failed when none of its due groups could be read
+        """
+        failed = failures > 0 and not meter_readings
+        if not failed:
+            readings[entry[0].address] = meter_readings
+        self._account(entry, started_at, failed)
+
+    def poll_blocking(self, budget_ms=None):
+        """Same as `poll`, for masters without the async transport"""
+        readings = {}
+        for entry in self._schedule(budget_ms):
+            meter = entry[0]
+            started_at = ticks_us()
+            meter_readings = {}
+            failures = 0
+            for group in self._due(entry[1]):
+                try:
+                    meter_readings.update(meter.read_planned(group[2]))
+                except Exception as e:
+                    failures += 1
+                    self._logger.error("Failed to read meter %s: %s", meter.address, e)
+                else:
+                    group[1] = ticks_ms()
+            self._collect(readings, entry, started_at, meter_readings, failures)
+        return readings
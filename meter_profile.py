@@ -0,0 +1,334 @@
+"""
+Meter profiles: the register map of a meter model, how its registers are decoded and sent as metrics,
+described as plain data, so supporting another model takes a JSON file rather than a new class
+
+    {
+        "name": "sdm120",
+        "baudrate": 2400,
+        "function_code": 4,
+        "byte_order": "big",
+        "word_order": "big",
+        "measurement": "power",
+        "registers": [
+            {"name": "voltage", "address": 0, "type": "float32", "field": "voltage", "tag": "line=A"},
+            {"name": "import_energy", "address": 72, "type": "uint32", "scale": 0.01, "word_order": "little",
+             "field": "watts_total", "tag": "type=active"}
+        ],
+        "groups": [
+            {"name": "instant", "interval": 0, "registers": ["voltage"]},
+            {"name": "energy", "interval": 300, "registers": ["import_energy"]}
+        ]
+    }
+
+- `type` is one of `TYPES`, the orders are "big" or "little", set for the whole profile and overridable per register
+- `scale` multiplies the value read, no scaling by default
+- `field` and optional `tag` tell how the register is sent, see `format_lines_multi`, registers without one aren't sent
+- `groups` are polled at their own interval in seconds, 0 meaning every probe. All the registers every probe by default
+
+Profiles are compiled once by `MeterProfile`: read plans come with a struct format per span,
+so a probe costs a single `unpack_from` per span whatever the profile looks like
+"""
+
+import json
+import logging
+import struct
+
+import modbus.defines as cst
+from meter_bus import MeterBus
+
+# Modbus allows up to 125 registers to be read by a single READ_INPUT_REGISTERS request
+MAX_READ_QUANTITY = 125
+# How many unused registers a single read may span to avoid starting another transaction.
+# A gap word costs ~2ms on a 9600 baud line, while a separate transaction costs tens of ms
+DEFAULT_MAX_GAP = 16
+
+# Register type -> (struct format character, size in words)
+TYPES = {
+    'uint16': ('H', 1),
+    'int16': ('h', 1),
+    'uint32': ('I', 2),
+    'int32': ('i', 2),
+    'float32': ('f', 2),
+}
+BYTE_ORDERS = {'big': '>', 'little': '<'}
+
+
+def plan_reads(registers, wanted, max_gap=DEFAULT_MAX_GAP, max_quantity=MAX_READ_QUANTITY):
+    """
+    Build the smallest set of contiguous register spans that covers the `wanted` registers.
+    `registers` maps the register names to their `(address, size in words)`.
+    Registers closer than `max_gap` unused words are merged into a single span,
+    as long as the span doesn't get longer than `max_quantity` words.
+
+    Returns a tuple of `(starting_address, quantity, ((name, offset), ...))` spans
+    where `offset` is the position of the register in words from the span start.
+    """
+    selected = []
+    for name in wanted:
+        if not name in registers:
+            raise ValueError(f'Unknown register name: {name}')
+        address, words = registers[name]
+        selected.append((address, words, name))
+    selected.sort()
+
+    spans = []
+    start = end = None
+    names = []
+    for address, words, name in selected:
+        if start is not None and address - end <= max_gap and address + words - start <= max_quantity:
+            names.append((name, address - start))
+            end = max(end, address + words)
+            continue
+
+        if start is not None:
+            spans.append((start, end - start, tuple(names)))
+        start, end = address, address + words
+        names = [(name, 0)]
+
+    if start is not None:
+        spans.append((start, end - start, tuple(names)))
+
+    return tuple(spans)
+
+
+def _format(codes):
+    """Join `(count, character)` pairs into a struct format body, e.g. '3f4xH'"""
+    return ''.join(character if count == 1 else f'{count}{character}' for count, character in codes)
+
+
+class MeterProfile:
+    """A meter profile compiled from its description, see the module docs for the format"""
+
+    def __init__(self, data):
+        self.name = data.get('name', 'meter')
+        self.baudrate = data.get('baudrate', 9600)
+        self.function_code = data.get('function_code', cst.READ_INPUT_REGISTERS)
+        self.measurement = data.get('measurement', self.name)
+
+        default_byte_order = data.get('byte_order', 'big')
+        default_word_order = data.get('word_order', 'big')
+        # name -> (address, size in words), in the profile order
+        self.registers = {}
+        self.register_names = []
+        # name -> (byte order character, struct format character, swap the words, scale)
+        self._decoding = {}
+        # (field, tag, register name) of the registers sent as metrics
+        self.fields = []
+        for register in data['registers']:
+            name = register['name']
+            try:
+                character, words = TYPES[register.get('type', 'float32')]
+                byte_order = BYTE_ORDERS[register.get('byte_order', default_byte_order)]
+                word_order = BYTE_ORDERS[register.get('word_order', default_word_order)]
+            except KeyError as e:
+                raise ValueError(f'Invalid type or order of register {name}: {e}')
+
+            self.registers[name] = (register['address'], words)
+            self.register_names.append(name)
+            # Words go the other way than the bytes in them, e.g. CDAB: swap the words and read in byte order
+            self._decoding[name] = (byte_order, character, words == 2 and byte_order != word_order, register.get('scale'))
+            if 'field' in register:
+                self.fields.append((register['field'], register.get('tag'), name))
+
+        self.groups = tuple(
+            (group['name'], tuple(group['registers']), group.get('interval', 0))
+            for group in data.get('groups', ({'name': 'all', 'registers': self.register_names},))
+        )
+
+    def plan(self, register_names=None, max_gap=DEFAULT_MAX_GAP):
+        """
+        Build a read plan for the given register names, all the registers of the profile by default
+        Returns a tuple of `(starting_address, quantity, decoders)` spans, `decoders` being meant for `decode`
+        """
+        if register_names is None:
+            register_names = self.register_names
+
+        return tuple(
+            (start, quantity, self._compile_span(names))
+            for start, quantity, names in plan_reads(self.registers, register_names, max_gap)
+        )
+
+    def _compile_span(self, names):
+        """
+        Compile the decoders of the `(name, offset)` registers of a span:
+        a tuple of `(byte_offset, data_format, names, scales, swaps, scratch)`, one per run of the same byte order.
+        The unused words between the registers of a run are skipped by pad bytes of the format
+        """
+        decoders = []
+        run = None
+        for name, offset in names:
+            byte_order, character, swap, scale = self._decoding[name]
+            words = self.registers[name][1]
+            if run is not None and (run[0] != byte_order or offset < run[2]):
+                decoders.append(self._compile_run(run))
+                run = None
+            if run is None:
+                # [byte order, start offset, end offset, (count, character) codes, names, scales, swaps]
+                run = [byte_order, offset, offset, [], [], [], []]
+
+            codes = run[3]
+            if offset > run[2]:
+                codes.append(((offset - run[2]) * 2, 'x'))
+            if codes and codes[-1][1] == character:
+                codes[-1] = (codes[-1][0] + 1, character)
+            else:
+                codes.append((1, character))
+            run[4].append(name)
+            run[5].append(scale)
+            if swap:
+                run[6].append((offset - run[1]) * 2)
+            run[2] = offset + words
+
+        if run is not None:
+            decoders.append(self._compile_run(run))
+        return tuple(decoders)
+
+    def _compile_run(self, run):
+        byte_order, start, end, codes, names, scales, swaps = run
+        # Scaling is skipped altogether when no register of the run needs it
+        scales = tuple(scales) if any(scale is not None for scale in scales) else None
+        # Words are swapped in a copy of the data, allocated here once
+        scratch = bytearray((end - start) * 2) if swaps else None
+        return start * 2, byte_order + _format(codes), tuple(names), scales, tuple(swaps), scratch
+
+    def decode(self, data, decoders, result_data):
+        """Decode the raw bytes of a span read according to its `decoders` into `result_data` by register name"""
+        for byte_offset, data_format, names, scales, swaps, scratch in decoders:
+            if swaps:
+                scratch[:] = data[byte_offset:byte_offset + len(scratch)]
+                for i in swaps:
+                    scratch[i], scratch[i + 1], scratch[i + 2], scratch[i + 3] = (
+                        scratch[i + 2], scratch[i + 3], scratch[i], scratch[i + 1]
+                    )
+                values = struct.unpack_from(data_format, scratch)
+            else:
+                values = struct.unpack_from(data_format, data, byte_offset)
+
+            if scales is None:
+                for i in range(len(names)):
+                    result_data[names[i]] = values[i]
+            else:
+                for i in range(len(names)):
+                    scale = scales[i]
+                    result_data[names[i]] = values[i] if scale is None else values[i] * scale
+
+    def encode(self, name, value):
+        """The opposite of `decode` for a single register: returns the words a meter holds for the value"""
+        byte_order, character, swap, scale = self._decoding[name]
+        if scale is not None:
+            value = value / scale
+        if character != 'f':
+            value = int(round(value))
+        data = struct.pack(byte_order + character, value)
+        if swap:
+            data = data[2:] + data[:2]
+        return struct.unpack(f'>{len(data) // 2}H', data)
+
+    def metric_fields(self, readings):
+        """Map the registers read from a meter to the metric fields, registers not read this time are left out"""
+        fields = {}
+        for field, tag, register in self.fields:
+            if not register in readings:
+                continue
+            if tag is None:
+                fields[field] = readings[register]
+            else:
+                fields.setdefault(field, {})[tag] = readings[register]
+        return fields
+
+
+def load_profile(path):
+    """Load and compile a JSON meter profile from the flash"""
+    with open(path) as f:
+        return MeterProfile(json.load(f))
+
+
+class Meter:
+    """A meter on a MeterBus, reading and decoding its registers as described by its profile"""
+
+    def __init__(self, bus, device_address, profile, verbose=False):
+        """
+        `bus` is the MeterBus the meter is connected to, shared with the other meters on the same RS-485 line
+        A `(uart_id, tx_pin, rx_pin, parity)` tuple can be passed instead, to have a bus of its own
+        """
+        if isinstance(bus, tuple):
+            bus = MeterBus.from_uart_data(bus, baudrate=profile.baudrate)
+        self._logger = logging.getLogger(f"modbus_rtu.{bus.name}.d{device_address}")
+
+        self._address = device_address
+        self._modbus = bus.master
+        self.profile = profile
+        if verbose:
+            self._logger.setLevel(logging.DEBUG)
+            self._logger.info('Setting verbose')
+            self._modbus.set_verbose(True)
+        else:
+            self._logger.setLevel(logging.INFO)
+
+    @property
+    def address(self):
+        return self._address
+
+    def execute(self, *args, **kwargs):
+        return self._modbus.execute(*args, **kwargs)
+
+    def read(self, register_name):
+        return self.read_planned(self.plan((register_name,)))[register_name]
+
+    def plan(self, register_names=None, max_gap=DEFAULT_MAX_GAP):
+        """
+        Build a read plan for the given register names, all the registers of the profile by default.
+        The plan is meant to be built once and passed to `read_planned` every probe
+        """
+        # Request frames are precompiled as well as the decoding,
+        # so every probe only runs the bus transactions and an unpack_from call per span
+        return tuple(
+            (
+                register, quantity,
+                self._modbus.prepare(self._address, self.profile.function_code, register, quantity),
+                decoders,
+            )
+            for register, quantity, decoders in self.profile.plan(register_names, max_gap)
+        )
+
+    def schedule(self, intervals=None, max_gap=DEFAULT_MAX_GAP):
+        """
+        Build a read plan per group of the profile, to be passed to `MeterBus.add_meter`
+        `intervals` overrides the default interval of the groups by their name
+        Returns a tuple of `(interval in seconds, plan)`
+        """
+        intervals = intervals or {}
+        return tuple(
+            (intervals.get(group, interval), self.plan(names, max_gap))
+            for group, names, interval in self.profile.groups
+        )
+
+    def read_planned(self, plan):
+        """Execute a read plan built by `plan` and decode the values back to register names"""
+        result_data = {}
+        for register, quantity, prepared, decoders in plan:
+            self._logger.info("Reading %d words starting from register %d", quantity, register)
+            data = self._modbus.execute_prepared(prepared, raw=True)
+            self.profile.decode(data, decoders, result_data)
+
+        return result_data
+
+    async def read_planned_async(self, plan):
+        """Same as `read_planned`, but lets other tasks run while waiting for the meter"""
+        result_data = {}
+        for register, quantity, prepared, decoders in plan:
+            self._logger.info("Reading %d words starting from register %d", quantity, register)
+            data = await self._modbus.execute_prepared_async(prepared, raw=True)
+            self.profile.decode(data, decoders, result_data)
+
+        return result_data
+
+    def read_multiple(self, starting_register_name, read_quantity):
+        """Read `read_quantity` registers in the profile order, starting from the given one"""
+        if not starting_register_name in self.profile.registers:
+            raise ValueError(f'Unknown register name: {starting_register_name}')
+
+        register_names = self.profile.register_names
+        starting_index = register_names.index(starting_register_name)
+
+        return self.read_planned(self.plan(register_names[starting_index:starting_index + read_quantity]))
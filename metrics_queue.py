@@ -0,0 +1,152 @@
+"""
+Store-and-forward queue of metrics batches on the flash, for the lines that couldn't be sent during an outage
+
+Batches are appended to segment files as records: `<length:u16><crc16:u16><line protocol bytes>`.
+Lines carry their own timestamps, so replaying them later puts them at the right place.
+The flash is spared the usual way: segments are only ever appended to and removed whole once replayed,
+nothing is rewritten in place. Replay progress within a segment is kept in memory only, a reboot may replay
+a few batches twice, which is harmless as the same timestamped points simply overwrite themselves.
+"""
+
+import os
+import struct
+
+from modbus.crc import calculate_crc
+
+RECORD_HEADER = '<HH'
+RECORD_HEADER_LENGTH = 4
+MAX_RECORD_LENGTH = 0xFFFF
+
+
+class FlashQueue:
+    """
+    Bounded queue of batches in `directory`, at most `max_segments` files of about `segment_bytes` each
+    Once full, the oldest segment is dropped to make room for the new batches
+    """
+
+    def __init__(self, directory='metrics_queue', segment_bytes=16384, max_segments=16):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        try:
+            os.mkdir(directory)
+        except OSError:
+            # Already there
+            pass
+
+        # Sequence numbers of the segments on the flash, oldest first
+        self._segments = sorted(int(name.split('.')[0]) for name in os.listdir(directory) if name.endswith('.seg'))
+        # A segment left by the previous boot may end with a half written record, new batches never go after it
+        self._active = None
+        self._active_length = 0
+        # Replay position in the oldest segment
+        self._read_offset = 0
+
+    def _path(self, segment):
+        return f'{self.directory}/{segment:08d}.seg'
+
+    def __len__(self):
+        """Number of segments waiting, the active one included"""
+        return len(self._segments)
+
+    def push(self, data):
+        """Append a batch, bigger batches are split in records at the line boundaries"""
+        if isinstance(data, str):
+            data = data.encode()
+        while len(data) > MAX_RECORD_LENGTH:
+            cut = data.rfind(b'\n', 0, MAX_RECORD_LENGTH)
+            if cut <= 0:
+                cut = MAX_RECORD_LENGTH
+            self._append(data[:cut])
+            data = data[cut + 1:] if data[cut:cut + 1] == b'\n' else data[cut:]
+        if data:
+            self._append(data)
+
+    def _append(self, data):
+        if self._active is None:
+            self._active = self._segments[-1] + 1 if self._segments else 0
+            self._active_length = 0
+            self._segments.append(self._active)
+            while len(self._segments) > self.max_segments:
+                self._drop_oldest()
+
+        with open(self._path(self._active), 'ab') as f:
+            f.write(struct.pack(RECORD_HEADER, len(data), calculate_crc(data)))
+            f.write(data)
+
+        self._active_length += RECORD_HEADER_LENGTH + len(data)
+        if self._active_length >= self.segment_bytes:
+            # Full, the next batch starts a new segment
+            self._active = None
+
+    def _drop_oldest(self):
+        segment = self._segments.pop(0)
+        self._read_offset = 0
+        try:
+            os.remove(self._path(segment))
+        except OSError:
+            pass
+
+    def _read_records(self, max_bytes):
+        """
+        Read the records of the oldest segment from the replay position, up to about `max_bytes` of them
+        Returns the records and the offset right after them, an empty list once the segment is over
+        """
+        records = []
+        length = 0
+        offset = self._read_offset
+        with open(self._path(self._segments[0]), 'rb') as f:
+            f.seek(offset)
+            while length < max_bytes:
+                header = f.read(RECORD_HEADER_LENGTH)
+                if len(header) < RECORD_HEADER_LENGTH:
+                    break
+                record_length, crc = struct.unpack(RECORD_HEADER, header)
+                data = f.read(record_length)
+                if len(data) < record_length or calculate_crc(data) != crc:
+                    # Cut short by a reboot in the middle of a write, nothing valid can follow
+                    break
+                records.append(data)
+                length += record_length
+                offset += RECORD_HEADER_LENGTH + record_length
+        return records, offset
+
+    def _next_body(self, max_bytes):
+        """The oldest batches joined into a single body, and the replay position after them. None when empty"""
+        while self._segments:
+            if self._segments[0] == self._active:
+                # Batches aren't appended to a segment being replayed, the next one starts a new segment
+                self._active = None
+            records, offset = self._read_records(max_bytes)
+            if not records:
+                # Everything in the oldest segment is sent
+                self._drop_oldest()
+                continue
+            return b'\n'.join(records), offset
+
+        return None, 0
+
+    def replay(self, send, max_bytes=8192):
+        """
+        Send the oldest batches through `send`, joined into a single body of about `max_bytes`
+        `send` is expected to raise when the batch isn't delivered, it's kept for the next replay then
+        Returns the number of bytes sent
+        """
+        body, offset = self._next_body(max_bytes)
+        if body is None:
+            return 0
+        send(body)
+        self._read_offset = offset
+        return len(body)
+
+    async def replay_async(self, send_async, max_bytes=8192):
+        """Same as `replay`, awaiting `send_async`"""
+        body, offset = self._next_body(max_bytes)
+        if body is None:
+            return 0
+        segment = self._segments[0]
+        await send_async(body)
+        # Batches pushed meanwhile may have pushed the segment out of a full queue
+        if self._segments and self._segments[0] == segment:
+            self._read_offset = offset
+        return len(body)
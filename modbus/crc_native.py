@@ -0,0 +1,15 @@
+"""
+Native backend for modbus.crc, same code as the python one but compiled to machine code
+Import fails on a host python and on ports built without the native emitter
+"""
+
+import micropython
+
+
+@micropython.native
+def crc16_update(crc, data, length, table):
+    if length != len(data):
+        data = memoryview(data)[:length]
+    for c in data:
+        crc = (crc >> 8) ^ table[(c ^ crc) & 0xFF]
+    return crc
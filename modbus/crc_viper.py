@@ -0,0 +1,15 @@
+"""
+Viper backend for modbus.crc, compiled to machine code working on raw pointers
+Import fails on a host python and on ports built without the viper emitter
+"""
+
+import micropython
+
+
+@micropython.viper
+def crc16_update(crc: int, data, length: int, table) -> int:
+    buf = ptr8(data)
+    tbl = ptr16(table)
+    for i in range(length):
+        crc = (crc >> 8) ^ tbl[(buf[i] ^ crc) & 0xFF]
+    return crc
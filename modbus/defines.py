@@ -23,6 +23,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+from modbus.utils import const
+
 #modbus exception codes
 ILLEGAL_FUNCTION = const(1)
 ILLEGAL_DATA_ADDRESS = const(2)
@@ -31,6 +33,8 @@ SLAVE_DEVICE_FAILURE = const(4)
 COMMAND_ACKNOWLEDGE = const(5)
 SLAVE_DEVICE_BUSY = const(6)
 MEMORY_PARITY_ERROR = const(8)
+GATEWAY_PATH_UNAVAILABLE = const(10)
+GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND = const(11)
 
 #supported modbus functions
 READ_COILS = const(1)
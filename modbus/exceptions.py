@@ -94,6 +94,19 @@ class ModbusInvalidResponseError(Exception):
     pass
 
 
+class ModbusInvalidCrcError(ModbusInvalidResponseError):
+    """
+    Exception raised when the CRC of the response sent by the slave
+    doesn't match its content
+    """
+    pass
+
+
+class ModbusTimeoutError(ModbusInvalidResponseError):
+    """Exception raised when the slave doesn't answer at all"""
+    pass
+
+
 class ModbusInvalidRequestError(Exception):
     """
     Exception raised when the request by the master doesn't fit
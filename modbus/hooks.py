@@ -62,6 +62,7 @@ def install_hook(name, fct):
     modbus.Master.before_send((master, request)) returns modified request or None
     modbus.Master.after_send((master))
     modbus.Master.after_recv((master, response)) returns modified response or None
+    modbus.Master.on_error((master, prepared_query, excpt))
 
     modbus.Slave.handle_request((slave, request_pdu)) returns modified response or None
     modbus.Slave.handle_write_multiple_coils_request((slave, request_pdu))
@@ -100,12 +101,12 @@ def uninstall_hook(name, fct=None):
 
 def call_hooks(name, args):
     """call the function associated with the hook and pass the given args"""
-    try:
-        for fct in _HOOKS[name]:
+    # No exception raised when there's no hook: it's called on every transaction and mostly without any hooks
+    fcts = _HOOKS.get(name)
+    if fcts:
+        for fct in fcts:
             retval = fct(args)
             if retval is not None:
                 return retval
-    except KeyError:
-        pass
     return None
 
@@ -30,10 +30,10 @@ from modbus import defines
 from modbus.exceptions import(
     ModbusError, ModbusFunctionNotSupportedError, DuplicatedKeyError, MissingKeyError, InvalidModbusBlockError,
     InvalidArgumentError, OverlapModbusBlockError, OutOfModbusBlockError, ModbusInvalidResponseError,
-    ModbusInvalidRequestError
+    ModbusInvalidRequestError, ModbusInvalidCrcError, ModbusTimeoutError
 )
 from modbus.hooks import call_hooks
-from modbus.utils import get_log_buffer
+from modbus.utils import get_log_buffer, ticks_ms, ticks_diff
 
 # modbus is using the python logging mechanism
 # you can define this logger in your app in order to see its prints logs
@@ -44,6 +44,9 @@ class Query(object):
     Interface to be implemented in subclass for every specific modbus MAC layer
     """
 
+    # slave id of the broadcasts, None for a MAC layer without any
+    broadcast_id = 0
+
     def __init__(self):
         """Constructor"""
         pass
@@ -81,21 +84,60 @@ class Query(object):
         raise NotImplementedError()
 
 
+class PreparedQuery(object):
+    """
+    A query built once by `Master.prepare`: the request frame ready to be sent
+    and everything needed to check and decode the response
+    """
+
+    def __init__(self, slave, query, request, expected_length, data_format, is_read_function, nb_of_digits):
+        """Constructor"""
+        self.slave = slave
+        self.query = query
+        self.request = request
+        self.expected_length = expected_length
+        self.data_format = data_format
+        self.is_read_function = is_read_function
+        self.nb_of_digits = nb_of_digits
+
+
 class Master(object):
     """
     This class implements the Modbus Application protocol for a master
     To be subclassed with a class implementing the MAC layer
     """
 
+    # Errors worth another attempt: the line garbled the response or the slave missed the request
+    RETRYABLE_ERRORS = (ModbusInvalidCrcError, ModbusTimeoutError)
+
     def __init__(self, hooks=None):
         """Constructor"""
         self._verbose = False
         self._is_opened = False
+        # How long to wait for a response in a single attempt, for the MAC layers that have such a timeout
+        self.timeout_ms = None
+        # A single attempt and no retries, until `set_retry_policy` is called
+        self.max_attempts = 1
+        self.retry_backoff_ms = 0
+        self.retry_deadline_ms = None
 
     def set_verbose(self, verbose):
         """print some more log prints for debug purpose"""
         self._verbose = verbose
 
+    def set_retry_policy(self, max_attempts=1, attempt_timeout_ms=None, deadline_ms=None, backoff_ms=0):
+        """
+        Retry the queries failing with one of the `RETRYABLE_ERRORS`, slave exceptions are never retried
+        - at most `max_attempts` transactions per query, each waiting `attempt_timeout_ms` for the response
+        - the input is flushed between the attempts, waiting `backoff_ms` doubled after every attempt
+        - no new attempt is started when it can't be over within `deadline_ms` since the query started
+        """
+        self.max_attempts = max(max_attempts, 1)
+        if attempt_timeout_ms is not None:
+            self.timeout_ms = attempt_timeout_ms
+        self.retry_deadline_ms = deadline_ms
+        self.retry_backoff_ms = backoff_ms
+
     def _send(self, buf):
         """Send data to a slave on the MAC layer"""
         raise NotImplementedError()
@@ -115,14 +157,144 @@ class Master(object):
         """
         raise NotImplementedError()
 
-    def execute(
+    async def _send_async(self, buf):
+        """Send data to a slave on the MAC layer without blocking the event loop"""
+        raise NotImplementedError()
+
+    async def _recv_async(self, expected_length):
+        """
+        Receive data from a slave on the MAC layer without blocking the event loop
+        Same semantics as `_recv`
+        """
+        raise NotImplementedError()
+
+    def prepare(
         self, slave, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="", expected_length=-1):
         """
+        Build a query once to execute it many times with `execute_prepared`
+        The request frame, its CRC, the expected response length and the data format are all computed here,
+        so polling the same registers over and over only costs the bus transaction itself
+        Arguments are the same as in `execute`
+        """
+        return PreparedQuery(slave, *self._build_request(
+            slave, function_code, starting_address, quantity_of_x, output_value, data_format, expected_length
+        ))
+
+    def execute(
+        self, slave, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="", expected_length=-1,
+        raw=False):
+        """
         Execute a modbus query and returns the data part of the answer as a tuple
         The returned tuple depends on the query function code. see modbus protocol
         specification for details
         data_format makes possible to extract the data like defined in the
         struct python module documentation
+        With raw=True the data bytes are returned as is, to be decoded by the caller in one go.
+        They may be a view on the receive buffer of the master, only valid until the next query
+        """
+        return self.execute_prepared(
+            self.prepare(slave, function_code, starting_address, quantity_of_x, output_value, data_format, expected_length),
+            raw,
+        )
+
+    async def execute_async(
+        self, slave, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="", expected_length=-1,
+        raw=False):
+        """
+        Same as `execute`, but waits for the bus without blocking the event loop
+        Requires the MAC layer to implement `_send_async` and `_recv_async`
+        """
+        return await self.execute_prepared_async(
+            self.prepare(slave, function_code, starting_address, quantity_of_x, output_value, data_format, expected_length),
+            raw,
+        )
+
+    def execute_prepared(self, prepared, raw=False):
+        """Execute a query built by `prepare`, see `execute` for the result and `set_retry_policy` for the retries"""
+        attempt = 1
+        started_at = ticks_ms()
+        while True:
+            try:
+                return self._transaction(prepared, raw)
+            except self.RETRYABLE_ERRORS as excpt:
+                wait_ms = self._retry_wait_ms(prepared, attempt, started_at, excpt)
+                if wait_ms is None:
+                    raise
+            attempt += 1
+            self._flush_input(wait_ms)
+
+    async def execute_prepared_async(self, prepared, raw=False):
+        """Same as `execute_prepared`, but waits for the bus without blocking the event loop"""
+        attempt = 1
+        started_at = ticks_ms()
+        while True:
+            try:
+                return await self._transaction_async(prepared, raw)
+            except self.RETRYABLE_ERRORS as excpt:
+                wait_ms = self._retry_wait_ms(prepared, attempt, started_at, excpt)
+                if wait_ms is None:
+                    raise
+            attempt += 1
+            await self._flush_input_async(wait_ms)
+
+    def _transaction(self, prepared, raw):
+        """A single request and response exchange"""
+        self._send(self._before_send(prepared.request))
+        call_hooks("modbus.Master.after_send", (self, ))
+
+        if prepared.slave != 0:
+            # receive the data from the slave
+            response = self._recv(prepared.expected_length)
+            try:
+                return self._parse_response(prepared, response, raw)
+            except Exception as excpt:
+                call_hooks("modbus.Master.on_error", (self, prepared, excpt))
+                raise
+
+    async def _transaction_async(self, prepared, raw):
+        """Same as `_transaction`, but waits for the bus without blocking the event loop"""
+        await self._send_async(self._before_send(prepared.request))
+        call_hooks("modbus.Master.after_send", (self, ))
+
+        if prepared.slave != 0:
+            # receive the data from the slave
+            response = await self._recv_async(prepared.expected_length)
+            try:
+                return self._parse_response(prepared, response, raw)
+            except Exception as excpt:
+                call_hooks("modbus.Master.on_error", (self, prepared, excpt))
+                raise
+
+    def _retry_wait_ms(self, prepared, attempt, started_at, excpt):
+        """How long to wait before the next attempt, None when the retry policy says to give up"""
+        if attempt >= self.max_attempts:
+            return None
+        wait_ms = self.retry_backoff_ms << (attempt - 1)
+        if self.retry_deadline_ms is not None:
+            # The next attempt has to be over before the deadline, even if it waits for the whole timeout
+            next_attempt_ms = wait_ms + (self.timeout_ms or 0)
+            if ticks_diff(ticks_ms(), started_at) + next_attempt_ms > self.retry_deadline_ms:
+                return None
+        LOGGER.warning("Attempt %d with slave %d failed: %s, retrying", attempt, prepared.slave, excpt)
+        return wait_ms
+
+    def _flush_input(self, wait_ms):
+        """
+        Get the line ready for the next attempt: wait at least `wait_ms`
+        and discard what is left of the broken response meanwhile
+        To be implemented by the MAC layer, retries follow each other right away otherwise
+        """
+        pass
+
+    async def _flush_input_async(self, wait_ms):
+        """Same as `_flush_input`, without blocking the event loop"""
+        pass
+
+    def _build_request(
+        self, slave, function_code, starting_address, quantity_of_x, output_value, data_format, expected_length):
+        """
+        Build the full request for the MAC layer and describe how to handle the answer
+        Returns (query, request, expected_length, data_format, is_read_function, nb_of_digits)
         """
 
         pdu = ""
@@ -261,62 +433,73 @@ class Master(object):
         # add the mac part of the protocol to the request
         request = query.build_request(pdu, slave)
 
-        # send the request to the slave
+        return query, request, expected_length, data_format, is_read_function, nb_of_digits
+
+    def _before_send(self, request):
+        """Give the hooks a chance to modify the request right before it's sent"""
         retval = call_hooks("modbus.Master.before_send", (self, request))
         if retval is not None:
             request = retval
         if self._verbose:
             LOGGER.debug(get_log_buffer("-> ", request))
-        self._send(request)
+        return request
 
-        call_hooks("modbus.Master.after_send", (self, ))
+    def _extract_pdu(self, query, response):
+        """Let the query check the MAC layer part of the response and return the pdu"""
+        return query.parse_response(response)
 
-        if slave != 0:
-            # receive the data from the slave
-            response = self._recv(expected_length)
-            retval = call_hooks("modbus.Master.after_recv", (self, response))
-            if retval is not None:
-                response = retval
-            if self._verbose:
-                LOGGER.debug(get_log_buffer("<- ", response))
-
-            # extract the pdu part of the response
-            response_pdu = query.parse_response(response)
-
-            # analyze the received data
-            (return_code, byte_2) = struct.unpack(">BB", response_pdu[0:2])
-
-            if return_code > 0x80:
-                # the slave has returned an error
-                exception_code = byte_2
-                raise ModbusError(exception_code)
+    def _parse_response(self, prepared, response, raw=False):
+        """Check the response received from the slave and return its data part as a tuple"""
+        retval = call_hooks("modbus.Master.after_recv", (self, response))
+        if retval is not None:
+            response = retval
+        if self._verbose:
+            LOGGER.debug(get_log_buffer("<- ", response))
+
+        # extract the pdu part of the response
+        response_pdu = self._extract_pdu(prepared.query, response)
+
+        if len(response_pdu) < 2:
+            raise ModbusInvalidResponseError("Response pdu length is invalid {0}".format(len(response_pdu)))
+
+        # analyze the received data
+        return_code, byte_2 = response_pdu[0], response_pdu[1]
+
+        if return_code > 0x80:
+            # the slave has returned an error
+            exception_code = byte_2
+            raise ModbusError(exception_code)
+        else:
+            if prepared.is_read_function:
+                # get the values returned by the reading function
+                byte_count = byte_2
+                data = response_pdu[2:]
+                if byte_count != len(data):
+                    # the byte count in the pdu is invalid
+                    raise ModbusInvalidResponseError(
+                        "Byte count is {0} while actual number of bytes is {1}. ".format(byte_count, len(data))
+                    )
             else:
-                if is_read_function:
-                    # get the values returned by the reading function
-                    byte_count = byte_2
-                    data = response_pdu[2:]
-                    if byte_count != len(data):
-                        # the byte count in the pdu is invalid
-                        raise ModbusInvalidResponseError(
-                            "Byte count is {0} while actual number of bytes is {1}. ".format(byte_count, len(data))
-                        )
-                else:
-                    # returns what is returned by the slave after a writing function
-                    data = response_pdu[1:]
-
-                # returns the data as a tuple according to the data_format
-                # (calculated based on the function or user-defined)
-                result = struct.unpack(data_format, data)
-                if nb_of_digits > 0:
-                    digits = []
-                    for byte_val in result:
-                        for i in range(8):
-                            if len(digits) >= nb_of_digits:
-                                break
-                            digits.append(byte_val % 2)
-                            byte_val = byte_val >> 1
-                    result = tuple(digits)
-                return result
+                # returns what is returned by the slave after a writing function
+                data = response_pdu[1:]
+
+            if raw:
+                return data
+
+            # returns the data as a tuple according to the data_format
+            # (calculated based on the function or user-defined)
+            result = struct.unpack(prepared.data_format, data)
+            nb_of_digits = prepared.nb_of_digits
+            if nb_of_digits > 0:
+                digits = []
+                for byte_val in result:
+                    for i in range(8):
+                        if len(digits) >= nb_of_digits:
+                            break
+                        digits.append(byte_val % 2)
+                        byte_val = byte_val >> 1
+                result = tuple(digits)
+            return result
 
 
 class ModbusBlock(object):
@@ -349,3 +532,218 @@ class ModbusBlock(object):
         """"""
         call_hooks("modbus.ModbusBlock.setitem", (self, item, value))
         return self._data.__setitem__(item, value)
+
+
+class Slave(object):
+    """
+    This class defines a modbus slave which is in charge of making the action
+    asked by a modbus query. Only the register reading functions are implemented
+    """
+
+    def __init__(self, slave_id):
+        """Constructor"""
+        self._id = slave_id
+        # block name -> (block type, ModbusBlock)
+        self._blocks = {}
+        self._memory = {
+            defines.ANALOG_INPUTS: [],
+            defines.HOLDING_REGISTERS: [],
+        }
+        self._fn_code_map = {
+            defines.READ_INPUT_REGISTERS: self._read_input_registers,
+            defines.READ_HOLDING_REGISTERS: self._read_holding_registers,
+        }
+
+    def _get_block_and_offset(self, block_type, address, length):
+        """returns the block and offset corresponding to the given address"""
+        for block in self._memory[block_type]:
+            if address >= block.starting_address:
+                offset = address - block.starting_address
+                if block.size >= offset + length:
+                    return block, offset
+
+        raise ModbusError(defines.ILLEGAL_DATA_ADDRESS)
+
+    def _read_registers(self, block_type, request_pdu):
+        """read the value of holding and input registers"""
+        (starting_address, quantity_of_x) = struct.unpack(">HH", request_pdu[1:5])
+
+        if (quantity_of_x <= 0) or (quantity_of_x > 125):
+            # maximum allowed size is 125 registers in one reading
+            LOGGER.debug("quantity_of_x is %d", quantity_of_x)
+            raise ModbusError(defines.ILLEGAL_DATA_VALUE)
+
+        # look for the block corresponding to the request
+        block, offset = self._get_block_and_offset(block_type, starting_address, quantity_of_x)
+
+        # get the values
+        values = block[offset:offset + quantity_of_x]
+
+        # the response header and every register on 2 bytes in one go, negative values as their two's complement
+        return struct.pack(">B%dH" % quantity_of_x, 2 * quantity_of_x, *[reg & 0xFFFF for reg in values])
+
+    def _read_holding_registers(self, request_pdu):
+        """handle read holding registers modbus function"""
+        call_hooks("modbus.Slave.handle_read_holding_registers_request", (self, request_pdu))
+        return self._read_registers(defines.HOLDING_REGISTERS, request_pdu)
+
+    def _read_input_registers(self, request_pdu):
+        """handle read input registers modbus function"""
+        call_hooks("modbus.Slave.handle_read_input_registers_request", (self, request_pdu))
+        return self._read_registers(defines.ANALOG_INPUTS, request_pdu)
+
+    def handle_request(self, request_pdu, broadcast=False):
+        """
+        parse the request pdu, makes the corresponding action
+        and returns the response pdu, None for a broadcast as nothing is answered to it
+        """
+        retval = call_hooks("modbus.Slave.handle_request", (self, request_pdu))
+        if retval is not None:
+            return retval
+
+        # get the function code
+        function_code = request_pdu[0]
+        try:
+            # check if the function code is valid. If not returns error response
+            if function_code not in self._fn_code_map:
+                raise ModbusError(defines.ILLEGAL_FUNCTION)
+
+            # only reading functions are supported, a broadcasted read is ignored like a real slave does
+            if broadcast:
+                LOGGER.debug("Function %d can not be broadcasted, ignored", function_code)
+                return None
+
+            # execute the corresponding function
+            response_pdu = self._fn_code_map[function_code](request_pdu)
+            if response_pdu:
+                return struct.pack(">B", function_code) + response_pdu
+            raise Exception("No response for function %d" % function_code)
+
+        except ModbusError as excpt:
+            LOGGER.debug(str(excpt))
+            call_hooks("modbus.Slave.on_exception", (self, function_code, excpt))
+            return struct.pack(">BB", function_code + 128, excpt.get_exception_code())
+
+    def add_block(self, block_name, block_type, starting_address, size):
+        """Add a new block identified by its name"""
+        # check block name
+        if block_name in self._blocks:
+            raise DuplicatedKeyError("Block {0} already exists. ".format(block_name))
+
+        if block_type not in self._memory:
+            raise InvalidModbusBlockError("Invalid block type {0}".format(block_type))
+
+        # check that the new block doesn't overlap an existing block
+        # it means that only 1 block per type must correspond to a given address
+        # for example: it must not have 2 holding registers at address 100
+        for block in self._memory[block_type]:
+            if block.is_in(starting_address, size):
+                raise OverlapModbusBlockError(
+                    "Overlap block at {0} size {1}".format(block.starting_address, block.size)
+                )
+
+        # if the block is ok: register it
+        block = ModbusBlock(starting_address, size, block_name)
+        self._blocks[block_name] = (block_type, block)
+        self._memory[block_type].append(block)
+
+    def set_values(self, block_name, address, values):
+        """
+        Set the values of the items at the given address
+        If values is a list or a tuple, the value of every item is written
+        If values is a number, only one value is written
+        """
+        # the block must exist
+        if block_name not in self._blocks:
+            raise MissingKeyError("block {0} not found".format(block_name))
+
+        (_, block) = self._blocks[block_name]
+        data = values if isinstance(values, (list, tuple)) else (values, )
+
+        # check that the requested data are in the given block
+        offset = address - block.starting_address
+        if offset < 0 or offset + len(data) > block.size:
+            raise OutOfModbusBlockError("address {0} size {1} is out of block {2}".format(address, len(data), block_name))
+
+        block[offset:offset + len(data)] = data
+
+    def get_values(self, block_name, address, size=1):
+        """return the values of n items at the given address of the given block"""
+        # the block must exist
+        if block_name not in self._blocks:
+            raise MissingKeyError("block {0} not found".format(block_name))
+
+        (_, block) = self._blocks[block_name]
+
+        # the requested data must be in the given block
+        offset = address - block.starting_address
+        if offset < 0 or offset + size > block.size:
+            raise OutOfModbusBlockError("address {0} size {1} is out of block {2}".format(address, size, block_name))
+
+        return tuple(block[offset:offset + size])
+
+
+class Databank(object):
+    """A databank is a shared place containing the data of all the slaves served by a server"""
+
+    def __init__(self):
+        """Constructor"""
+        # slave id -> Slave
+        self._slaves = {}
+
+    def add_slave(self, slave_id):
+        """Add a new slave with the given id"""
+        if (slave_id <= 0) or (slave_id > 255):
+            raise InvalidArgumentError("Invalid slave id {0}".format(slave_id))
+        if slave_id in self._slaves:
+            raise DuplicatedKeyError("Slave {0} already exists".format(slave_id))
+
+        self._slaves[slave_id] = slave = Slave(slave_id)
+        return slave
+
+    def get_slave(self, slave_id):
+        """Get the slave with the given id"""
+        if slave_id not in self._slaves:
+            raise MissingKeyError("Slave {0} doesn't exist".format(slave_id))
+        return self._slaves[slave_id]
+
+    def handle_request(self, query, request):
+        """
+        When a request is received, handle it and returns the response frame
+        An empty response means nothing is to be sent back
+        """
+        request_pdu = None
+        try:
+            # extract the pdu and the slave id
+            (slave_id, request_pdu) = query.parse_request(request)
+
+            if slave_id == query.broadcast_id:
+                # broadcasts are only handled by the slaves, none of them answers
+                for slave in self._slaves.values():
+                    slave.handle_request(request_pdu, broadcast=True)
+                return ""
+
+            if slave_id in (0, 255) and slave_id not in self._slaves and len(self._slaves) == 1:
+                # without broadcasts, 0 and 255 are what clients send to "the device" by default
+                slave_id = next(iter(self._slaves))
+
+            response_pdu = self.get_slave(slave_id).handle_request(request_pdu)
+            return query.build_response(response_pdu)
+
+        except MissingKeyError as excpt:
+            # the way a gateway tells about a device it doesn't know
+            call_hooks("modbus.Databank.on_error", (self, excpt, request_pdu))
+            return query.build_response(
+                struct.pack(">BB", request_pdu[0] | 0x80, defines.GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+            )
+        except ModbusInvalidRequestError as excpt:
+            # a malformed request gets no answer at all
+            call_hooks("modbus.Databank.on_error", (self, excpt, request_pdu))
+            LOGGER.debug(str(excpt))
+            return ""
+        except Exception as excpt:
+            call_hooks("modbus.Databank.on_error", (self, excpt, request_pdu))
+            LOGGER.error("handle request failed: %s", excpt)
+            if not request_pdu:
+                return ""
+            return query.build_response(struct.pack(">BB", request_pdu[0] | 0x80, defines.SLAVE_DEVICE_FAILURE))
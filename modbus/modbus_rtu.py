@@ -27,10 +27,16 @@ import struct
 
 from modbus import LOGGER
 from modbus.modbus import ( Query, Master,
-    InvalidArgumentError, ModbusInvalidResponseError, ModbusInvalidRequestError
+    InvalidArgumentError, ModbusInvalidResponseError, ModbusInvalidRequestError, ModbusInvalidCrcError,
+    ModbusTimeoutError
 )
 from modbus.hooks import call_hooks
 from modbus import utils
+from modbus.crc import Crc16
+from modbus.utils import const
+
+# Biggest possible Modbus RTU frame: slave + 253 bytes pdu + crc1 + crc2
+MAX_FRAME_LENGTH = const(256)
 
 # Some values used in the serial_prep callback
 serial_cb_tx_begin = const(0x01)
@@ -56,13 +62,19 @@ class RtuQuery(Query):
         crc = struct.pack(">H", utils.calculate_crc(data))
         return data + crc
 
-    def parse_response(self, response):
-        """Extract the pdu from the Modbus RTU response"""
-        print(response)
-        if len(response) < 3:
-            raise ModbusInvalidResponseError("Response length is invalid {0}".format(len(response)))
+    def parse_response(self, response, frame_crc=None):
+        """
+        Extract the pdu from the Modbus RTU response
+        When a memoryview is given, the pdu is a view on the same buffer and nothing is copied
+        frame_crc is the CRC of the whole response including its CRC bytes, when already computed while receiving it
+        """
+        response_length = len(response)
+        if response_length == 0:
+            raise ModbusTimeoutError("No response from slave {0}".format(self._request_address))
+        if response_length < 3:
+            raise ModbusInvalidResponseError("Response length is invalid {0}".format(response_length))
 
-        (self._response_address, ) = struct.unpack(">B", response[0:1])
+        self._response_address = response[0]
 
         if self._request_address != self._response_address:
             raise ModbusInvalidResponseError(
@@ -71,12 +83,17 @@ class RtuQuery(Query):
                 )
             )
 
-        (crc, ) = struct.unpack(">H", response[-2:])
+        if frame_crc is None:
+            crc = (response[response_length - 2] << 8) | response[response_length - 1]
+            crc_valid = crc == utils.calculate_crc(response[:response_length - 2])
+        else:
+            # The CRC of a valid frame followed by its own CRC is always zero
+            crc_valid = frame_crc == 0
 
-        if crc != utils.calculate_crc(response[:-2]):
-            raise ModbusInvalidResponseError("Invalid CRC in response")
+        if not crc_valid:
+            raise ModbusInvalidCrcError("Invalid CRC in response")
 
-        return response[1:-2]
+        return response[1:response_length - 2]
 
     def parse_request(self, request):
         """Extract the pdu from the Modbus RTU request"""
@@ -102,8 +119,11 @@ class RtuQuery(Query):
 class RtuMaster(Master):
     """Subclass of Master. Implements the Modbus RTU MAC layer"""
 
-    def __init__(self, serial, serial_prep_cb = None):
-        """Constructor. Pass the machine.UART object"""
+    def __init__(self, serial, serial_prep_cb = None, baudrate=9600, timeout_ms=1000):
+        """
+        Constructor. Pass the machine.UART object, its baudrate
+        and how long to wait for the slave to start answering
+        """
         self._serial = serial
         self._serial_prep = serial_prep_cb
         super(RtuMaster, self).__init__()
@@ -112,6 +132,17 @@ class RtuMaster(Master):
         # So read echo data and discard it.
         self.handle_local_echo = False
 
+        self.timeout_ms = timeout_ms
+        # Responses are received into the same buffer every time to avoid heap allocations
+        # Note: it means the response returned by `_recv` is only valid until the next transaction
+        self._rx_buf = bytearray(MAX_FRAME_LENGTH)
+        self._rx_view = memoryview(self._rx_buf)
+        # The CRC is computed while the bytes are arriving, for free in the gaps between them
+        self._rx_crc = Crc16()
+        self._rx_frame = None
+        # A frame is over once the line stays silent for 3.5 characters
+        self.frame_silence_us = int(utils.calculate_rtu_frame_silence(baudrate) * 1000000)
+
     def _send(self, request):
         """Send request to the slave"""
         retval = call_hooks("modbus_rtu.RtuMaster.before_send", (self, request))
@@ -138,27 +169,87 @@ class RtuMaster(Master):
             if self._serial_prep:
                 self._serial_prep(serial_cb_rx_end)
 
-    def _recv(self, expected_length=-1):
-        """Receive the response from the slave"""
-        response = utils.to_data("")
+    def _flush_input(self, wait_ms):
+        """
+        Discard the rest of a broken response: wait until the line stays silent for t3.5,
+        but at least `wait_ms` in total, throwing away every byte arriving meanwhile
+        """
+        started_at = utils.ticks_us()
+        last_byte_at = started_at
         while True:
-            if self._serial_prep:
-                self._serial_prep(serial_cb_rx_begin)
-            read_bytes = self._serial.read(expected_length if expected_length > 0 else 1)
-            if self._serial_prep:
-                self._serial_prep(serial_cb_rx_end)
-            if not read_bytes:
+            now = utils.ticks_us()
+            available = self._serial.any()
+            if available:
+                self._serial.read(available)
+                last_byte_at = utils.ticks_us()
+            elif (utils.ticks_diff(now, last_byte_at) >= self.frame_silence_us
+                  and utils.ticks_diff(now, started_at) >= wait_ms * 1000):
                 break
-            response += read_bytes
-            if expected_length >= 0 and len(response) >= expected_length:
-                #if the expected number of byte is received consider that the response is done
-                #improve performance by avoiding end-of-response detection by timeout
+
+    def _is_frame_complete(self, response, length, expected_length):
+        """Tells if the response is done without waiting for the inter-frame silence"""
+        if expected_length >= 0 and length >= expected_length:
+            return True
+        # Exception responses are always slave + func|0x80 + exception code + crc1 + crc2
+        return length >= 5 and response[1] & 0x80 != 0
+
+    def _recv(self, expected_length=-1):
+        """
+        Receive the response from the slave into the reusable buffer and return a memoryview on it
+        The response is done when expected_length bytes are received, when an exception frame is complete,
+        or when the line stays silent for t3.5 after the last byte
+        """
+        length = 0
+        self._rx_crc.reset()
+        if self._serial_prep:
+            self._serial_prep(serial_cb_rx_begin)
+
+        started_at = utils.ticks_us()
+        last_byte_at = None
+        while True:
+            # Take the time before looking at the UART: a byte arriving in between is seen,
+            # so the line was really silent since `last_byte_at` up to `now` when nothing is there
+            now = utils.ticks_us()
+            available = self._serial.any()
+            if available:
+                if expected_length > 0:
+                    available = min(available, expected_length - length)
+                available = min(available, MAX_FRAME_LENGTH - length)
+                if not available:
+                    # The slave keeps talking past the biggest possible frame, it's garbage anyway
+                    break
+                chunk = self._rx_view[length:length + available]
+                read_length = self._serial.readinto(chunk)
+                self._rx_crc.update(chunk, read_length)
+                length += read_length
+                last_byte_at = utils.ticks_us()
+                if self._is_frame_complete(self._rx_buf, length, expected_length):
+                    break
+            elif last_byte_at is None:
+                if utils.ticks_diff(now, started_at) >= self.timeout_ms * 1000:
+                    # The slave didn't answer at all
+                    break
+            elif utils.ticks_diff(now, last_byte_at) >= self.frame_silence_us:
                 break
 
-        retval = call_hooks("modbus_rtu.RtuMaster.after_recv", (self, response))
+        if self._serial_prep:
+            self._serial_prep(serial_cb_rx_end)
+
+        return self._received(length)
+
+    def _received(self, length):
+        """Returns the response received into the buffer, after letting the hooks modify it"""
+        self._rx_frame = self._rx_view[:length]
+        retval = call_hooks("modbus_rtu.RtuMaster.after_recv", (self, self._rx_frame))
         if retval is not None:
             return retval
-        return response
+        return self._rx_frame
+
+    def _extract_pdu(self, query, response):
+        """Reuse the CRC computed while receiving, unless a hook replaced the response"""
+        if response is self._rx_frame:
+            return query.parse_response(response, self._rx_crc.value)
+        return query.parse_response(response)
 
     def _make_query(self):
         """Returns an instance of a Query subclass implementing the modbus RTU protocol"""
@@ -0,0 +1,109 @@
+"""
+Modbus RTU master that waits for the bus on uasyncio streams instead of blocking
+on `UART.read`, so the rest of the event loop keeps running during a transaction.
+"""
+
+import uasyncio
+
+from modbus.modbus_rtu import (
+    RtuMaster, MAX_FRAME_LENGTH, serial_cb_tx_begin, serial_cb_tx_end, serial_cb_rx_begin, serial_cb_rx_end
+)
+from modbus.hooks import call_hooks
+
+
+class AsyncRtuMaster(RtuMaster):
+    """
+    Subclass of RtuMaster that also implements `execute_async`
+    The blocking `execute` keeps working on the same object
+    """
+
+    def __init__(self, serial, serial_prep_cb=None, baudrate=9600, timeout_ms=1000):
+        """Constructor. Same arguments as RtuMaster"""
+        super(AsyncRtuMaster, self).__init__(serial, serial_prep_cb, baudrate, timeout_ms)
+        self._reader = uasyncio.StreamReader(serial)
+        self._writer = uasyncio.StreamWriter(serial, {})
+        # wait_for_ms can't wait for less than a millisecond, so round t3.5 up
+        self._frame_silence_ms = self.frame_silence_us // 1000 + 1
+
+    async def _read_available(self, length, max_length):
+        """
+        Wait for the bytes to arrive and read at most `max_length` of them into the receive buffer at `length`
+        Never asks the UART for more bytes than it has, so the read itself never blocks
+        """
+        chunk = self._rx_view[length:length + min(max_length, max(self._serial.any(), 1))]
+        read_length = await self._reader.readinto(chunk)
+        if read_length:
+            self._rx_crc.update(chunk, read_length)
+        return read_length
+
+    async def _send_async(self, request):
+        """Send request to the slave"""
+        retval = call_hooks("modbus_rtu.RtuMaster.before_send", (self, request))
+        if retval is not None:
+            request = retval
+
+        # Throw away any waiting bytes, to clear the buffer
+        while self._serial.any() > 0:
+            self._serial.read(self._serial.any())
+
+        if self._serial_prep:
+            self._serial_prep(serial_cb_tx_begin)
+        self._writer.write(request)
+        await self._writer.drain()
+        if self._serial_prep:
+            self._serial_prep(serial_cb_tx_end)
+
+        # Read the echo data, and discard it
+        if self.handle_local_echo:
+            if self._serial_prep:
+                self._serial_prep(serial_cb_rx_begin)
+            await uasyncio.wait_for_ms(self._reader.readexactly(len(request)), self.timeout_ms)
+            if self._serial_prep:
+                self._serial_prep(serial_cb_rx_end)
+
+    async def _flush_input_async(self, wait_ms):
+        """Same as `_flush_input`, sleeping instead of polling the UART"""
+        await uasyncio.sleep_ms(wait_ms)
+        while True:
+            await uasyncio.sleep_ms(self._frame_silence_ms)
+            available = self._serial.any()
+            if not available:
+                break
+            self._serial.read(available)
+
+    async def _recv_async(self, expected_length=-1):
+        """
+        Receive the response from the slave, yielding to other tasks while waiting for bytes
+        Detects the end of the response and reuses the receive buffer the same way as `_recv`
+        """
+        length = 0
+        self._rx_crc.reset()
+        if self._serial_prep:
+            self._serial_prep(serial_cb_rx_begin)
+
+        # Wait for the whole response timeout for the first byte, then only for t3.5 between the bytes
+        wait_ms = self.timeout_ms
+        while True:
+            max_length = MAX_FRAME_LENGTH - length
+            if expected_length > 0:
+                max_length = min(max_length, expected_length - length)
+            if max_length <= 0:
+                break
+            try:
+                read_length = await uasyncio.wait_for_ms(self._read_available(length, max_length), wait_ms)
+            except uasyncio.TimeoutError:
+                if self._serial.any():
+                    # Another task held the loop longer than t3.5, the bytes did arrive meanwhile
+                    continue
+                break
+            if not read_length:
+                break
+            length += read_length
+            if self._is_frame_complete(self._rx_buf, length, expected_length):
+                break
+            wait_ms = self._frame_silence_ms
+
+        if self._serial_prep:
+            self._serial_prep(serial_cb_rx_end)
+
+        return self._received(length)
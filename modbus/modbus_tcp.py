@@ -0,0 +1,135 @@
+"""
+Modbus TCP server on uasyncio streams, answering from the slaves of a Databank
+
+The TCP side never touches the serial line: the databank is the only thing the clients see,
+so any number of them can read while the RTU master polls the meters on its own schedule.
+"""
+
+import struct
+
+import uasyncio
+
+from modbus import LOGGER
+from modbus.modbus import Query, ModbusInvalidRequestError
+from modbus.hooks import call_hooks
+from modbus.utils import const
+
+# transaction id + protocol id + length + unit id
+MBAP_HEADER_LENGTH = const(7)
+# Biggest possible pdu, the unit id is counted by the MBAP length too
+MAX_PDU_LENGTH = const(253)
+
+
+class TcpQuery(Query):
+    """Subclass of a Query. Adds the Modbus TCP specific part of the protocol, server side only"""
+
+    # Modbus TCP has no broadcast, a request to unit 0 expects an answer like any other
+    broadcast_id = None
+
+    def __init__(self):
+        """Constructor"""
+        super(TcpQuery, self).__init__()
+        self._request_mbap = None
+
+    def parse_request(self, request):
+        """Extract the pdu from a Modbus TCP request, returns the unit id and the pdu"""
+        if len(request) <= MBAP_HEADER_LENGTH:
+            raise ModbusInvalidRequestError("Request length is only {0} bytes".format(len(request)))
+
+        (transaction_id, protocol_id, length, unit_id) = struct.unpack(">HHHB", request[:MBAP_HEADER_LENGTH])
+        if protocol_id != 0:
+            raise ModbusInvalidRequestError("Invalid protocol id {0}".format(protocol_id))
+        if length != len(request) - MBAP_HEADER_LENGTH + 1:
+            raise ModbusInvalidRequestError("Request length is {0}, MBAP says {1}".format(len(request), length))
+
+        self._request_mbap = (transaction_id, unit_id)
+        return unit_id, request[MBAP_HEADER_LENGTH:]
+
+    def build_response(self, response_pdu):
+        """Add the MBAP header of the request to the response pdu"""
+        (transaction_id, unit_id) = self._request_mbap
+        return struct.pack(">HHHB", transaction_id, 0, len(response_pdu) + 1, unit_id) + response_pdu
+
+
+class TcpServer(object):
+    """
+    Modbus TCP server answering the requests with the data of a Databank
+    Every client is served by its own task, requests of a client are answered in order
+    """
+
+    def __init__(self, databank, port=502, address='0.0.0.0', timeout_s=60, max_clients=4):
+        """
+        Constructor: `timeout_s` is how long an idle client keeps its connection,
+        clients over `max_clients` are disconnected right away, each of them costs a socket and its buffers
+        """
+        self._databank = databank
+        self._port = port
+        self._address = address
+        self.timeout_s = timeout_s
+        self.max_clients = max_clients
+        self._clients = 0
+        self._server = None
+
+    async def start(self):
+        """Start accepting the clients, the server runs in the background of the event loop"""
+        self._server = await uasyncio.start_server(self._handle_client, self._address, self._port)
+        LOGGER.info("Modbus TCP server listening on %s:%d", self._address, self._port)
+
+    def stop(self):
+        """Stop accepting the clients"""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _read_request(self, reader):
+        """Read a whole request frame, None when the client is gone or sends something else than Modbus"""
+        header = await uasyncio.wait_for(reader.readexactly(MBAP_HEADER_LENGTH), self.timeout_s)
+        (_, protocol_id, length) = struct.unpack(">HHH", header[:6])
+        if protocol_id != 0 or length < 2 or length > MAX_PDU_LENGTH + 1:
+            return None
+        return header + await uasyncio.wait_for(reader.readexactly(length - 1), self.timeout_s)
+
+    async def _handle_client(self, reader, writer):
+        """Answer the requests of a client until it disconnects"""
+        if self._clients >= self.max_clients:
+            writer.close()
+            await writer.wait_closed()
+            return
+
+        self._clients += 1
+        call_hooks("modbus_tcp.TcpServer.on_connect", (self, writer, writer.get_extra_info('peername')))
+        query = TcpQuery()
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                retval = call_hooks("modbus_tcp.TcpServer.after_recv", (self, writer, request))
+                if retval is not None:
+                    request = retval
+
+                retval = call_hooks("modbus.Server.before_handle_request", (self, request))
+                if retval is not None:
+                    request = retval
+                response = self._databank.handle_request(query, request)
+                retval = call_hooks("modbus.Server.after_handle_request", (self, response))
+                if retval is not None:
+                    response = retval
+
+                if response:
+                    retval = call_hooks("modbus_tcp.TcpServer.before_send", (self, writer, response))
+                    if retval is not None:
+                        response = retval
+                    writer.write(response)
+                    await writer.drain()
+        except (EOFError, OSError, uasyncio.TimeoutError):
+            # The client is gone or idle for too long
+            pass
+        except Exception as excpt:
+            call_hooks("modbus_tcp.TcpServer.on_error", (self, writer, excpt))
+            LOGGER.error("Error while handling a Modbus TCP client: %s", excpt)
+        finally:
+            self._clients -= 1
+            call_hooks("modbus_tcp.TcpServer.on_disconnect", (self, writer))
+            writer.close()
+            await writer.wait_closed()
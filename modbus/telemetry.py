@@ -0,0 +1,125 @@
+"""
+Modbus transaction telemetry, collected through the master hooks per slave and function code:
+round-trip latency histogram, bytes transferred, CRC failures, slave exceptions and timeouts.
+Nothing is collected and nothing costs anything until `BusTelemetry.install` is called.
+"""
+
+from modbus.exceptions import ModbusError, ModbusInvalidCrcError, ModbusTimeoutError
+from modbus.hooks import install_hook, uninstall_hook
+from modbus.utils import ticks_us, ticks_diff
+
+# Upper bounds of the latency histogram buckets in ms, the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000)
+
+
+class TransactionStats:
+    """Counters of the transactions with a single slave and function code"""
+
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.crc_errors = 0
+        self.exceptions = 0
+        self.timeouts = 0
+        self.other_errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_us_sum = 0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add_latency(self, latency_us):
+        self.latency_us_sum += latency_us
+        latency_ms = latency_us // 1000
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                self.latency_histogram[i] += 1
+                return
+        self.latency_histogram[-1] += 1
+
+    def fields(self):
+        """All the counters as line protocol fields, histogram buckets are cumulative like in Prometheus"""
+        fields = {
+            'requests': self.requests,
+            'responses': self.responses,
+            'crc_errors': self.crc_errors,
+            'exceptions': self.exceptions,
+            'timeouts': self.timeouts,
+            'other_errors': self.other_errors,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency_ms_sum': self.latency_us_sum / 1000,
+        }
+        cumulative = 0
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            cumulative += self.latency_histogram[i]
+            fields[f'latency_le_{bound}ms'] = cumulative
+        fields['latency_le_inf'] = cumulative + self.latency_histogram[-1]
+        return fields
+
+
+class BusTelemetry:
+    """
+    Collects `TransactionStats` for every `(slave, function code)` seen on the masters
+
+    Relies on the RTU frame layout for the slave and the function code: the first 2 bytes of the request
+    """
+
+    def __init__(self):
+        # (slave, function code) -> TransactionStats
+        self.stats = {}
+        self._current = None
+        self._sent_at = 0
+        # Bound methods are kept, as a new bound method object wouldn't be found by `uninstall_hook`
+        self._hooks = (
+            ("modbus.Master.before_send", self._before_send),
+            ("modbus.Master.after_recv", self._after_recv),
+            ("modbus.Master.on_error", self._on_error),
+        )
+
+    def install(self):
+        for name, fct in self._hooks:
+            install_hook(name, fct)
+
+    def uninstall(self):
+        for name, fct in self._hooks:
+            uninstall_hook(name, fct)
+
+    def _before_send(self, args):
+        _, request = args
+        key = (request[0], request[1])
+        try:
+            stats = self.stats[key]
+        except KeyError:
+            stats = self.stats[key] = TransactionStats()
+        stats.requests += 1
+        stats.bytes_sent += len(request)
+        self._current = stats
+        self._sent_at = ticks_us()
+
+    def _after_recv(self, args):
+        _, response = args
+        stats = self._current
+        if stats is None or not len(response):
+            return
+        stats.responses += 1
+        stats.bytes_received += len(response)
+        stats.add_latency(ticks_diff(ticks_us(), self._sent_at))
+
+    def _on_error(self, args):
+        _, _, excpt = args
+        stats = self._current
+        if stats is None:
+            return
+        if isinstance(excpt, ModbusTimeoutError):
+            stats.timeouts += 1
+        elif isinstance(excpt, ModbusInvalidCrcError):
+            stats.crc_errors += 1
+        elif isinstance(excpt, ModbusError):
+            stats.exceptions += 1
+        else:
+            stats.other_errors += 1
+
+    def items(self):
+        """Yields `(slave, function code, TransactionStats)`"""
+        for (slave, function_code), stats in self.stats.items():
+            yield slave, function_code, stats
@@ -0,0 +1,279 @@
+"""
+MQTT 3.1.1 publisher on uasyncio streams, see https://docs.oasis-open.org/mqtt/mqtt/v3.1.1/os/mqtt-v3.1.1-os.html
+Only what publishing needs: CONNECT with a persistent session, PUBLISH at QoS 0 or 1, PINGREQ and DISCONNECT
+
+    client = MqttClient('192.168.1.10', client_id='powermon-1')
+    client.start()
+    await client.publish('powermon/workshop', b'environment temperature=21.5', qos=1)
+"""
+
+import struct
+
+import uasyncio
+
+from modbus.utils import ticks_ms, ticks_diff
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+CONNECT_CLEAN_SESSION = 0x02
+CONNECT_PASSWORD = 0x40
+CONNECT_USERNAME = 0x80
+PUBLISH_DUP = 0x08
+PUBLISH_RETAIN = 0x01
+
+
+class MqttError(OSError):
+    """The broker refused the connection or broke the protocol"""
+
+
+def encode_length(length):
+    """The variable length "remaining length" of the fixed header"""
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack('>H', len(value)) + value
+
+
+class MqttClient:
+    """
+    A single connection to the broker, opened again whenever it breaks
+    With `clean_session` off the broker keeps the session while the board is away, a QoS 1 message
+    that wasn't acknowledged is sent again with the DUP flag once reconnected
+    """
+
+    def __init__(
+            self, host, port=1883, client_id='powermon', username=None, password=None,
+            keepalive=60, clean_session=False, timeout=10, ssl=False,
+        ):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.clean_session = clean_session
+        self.timeout = timeout
+        self.ssl = ssl
+        self._reader = None
+        self._writer = None
+        self._packet_id = 0
+        # Packet id of the QoS 1 publish waiting for its PUBACK, and the event it's waiting on
+        self._pending_id = None
+        self._acked = uasyncio.Event()
+        # The keepalive task and a publish may both find the connection gone, only one of them reconnects
+        self._connect_lock = uasyncio.Lock()
+        self._keepalive_task = None
+        self._last_received_ms = 0
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    def start(self):
+        """Start the keepalive task, it connects too, so the session is up before the first publish"""
+        if self._keepalive_task is None:
+            self._keepalive_task = uasyncio.create_task(self._keepalive_loop())
+
+    def _connect_packet(self):
+        flags = CONNECT_CLEAN_SESSION if self.clean_session else 0
+        payload = encode_string(self.client_id)
+        if self.username is not None:
+            flags |= CONNECT_USERNAME
+            payload += encode_string(self.username)
+            if self.password is not None:
+                flags |= CONNECT_PASSWORD
+                payload += encode_string(self.password)
+        variable_header = encode_string('MQTT') + struct.pack('>BBH', 4, flags, self.keepalive)
+        return bytes((CONNECT, )) + encode_length(len(variable_header) + len(payload)) + variable_header + payload
+
+    async def connect(self):
+        """Connect, unless it's connected already"""
+        async with self._connect_lock:
+            if not self.connected:
+                await self._open()
+
+    async def _open(self):
+        reader, writer = await uasyncio.wait_for(uasyncio.open_connection(
+            self.host, self.port, ssl=self.ssl or None, server_hostname=self.host if self.ssl else None,
+        ), self.timeout)
+        try:
+            writer.write(self._connect_packet())
+            await writer.drain()
+            connack = await uasyncio.wait_for(reader.readexactly(4), self.timeout)
+        except Exception:
+            writer.close()
+            raise
+        if connack[0] != CONNACK or connack[3] != 0:
+            writer.close()
+            raise MqttError(f'Connection refused by the broker, return code {connack[3]}')
+
+        self._reader, self._writer = reader, writer
+        self._last_received_ms = ticks_ms()
+        uasyncio.create_task(self._read_loop(reader))
+
+    def close(self):
+        """Drop the connection, without a DISCONNECT so the broker keeps the session"""
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+            self._reader = self._writer = None
+
+    async def disconnect(self):
+        """Say goodbye to the broker properly"""
+        if self._writer is not None:
+            try:
+                self._writer.write(bytes((DISCONNECT, 0)))
+                await self._writer.drain()
+            except OSError:
+                pass
+            self.close()
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, (await reader.readexactly(length) if length else b'')
+
+    async def _read_loop(self, reader):
+        """Handle what the broker sends, until the connection it reads from is gone"""
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                self._last_received_ms = ticks_ms()
+                if header & 0xF0 == PUBACK and struct.unpack('>H', body)[0] == self._pending_id:
+                    self._acked.set()
+                # PINGRESP only tells the broker is there, nothing is subscribed to
+        except (EOFError, OSError) as e:
+            if self._reader is reader:
+                print(f'MQTT connection lost: {e}')
+                self.close()
+                # Wakes up a publish waiting for its PUBACK, it finds the connection gone
+                self._acked.set()
+
+    async def _keepalive_loop(self):
+        """Ping the broker often enough for it to keep the connection, connect again once it's gone"""
+        interval = self.keepalive // 2 or 1
+        while True:
+            try:
+                if not self.connected:
+                    await self.connect()
+                elif ticks_diff(ticks_ms(), self._last_received_ms) > self.keepalive * 1500:
+                    # Not even a PINGRESP for too long, the connection is dead without knowing it
+                    self.close()
+                    continue
+                else:
+                    self._writer.write(bytes((PINGREQ, 0)))
+                    await self._writer.drain()
+            except Exception as e:
+                print(f'MQTT keepalive failed: {e}')
+                self.close()
+            await uasyncio.sleep(interval)
+
+    def _next_packet_id(self):
+        self._packet_id = self._packet_id % 0xFFFF + 1
+        return self._packet_id
+
+    async def _send_publish(self, topic, payload, qos, retain, packet_id, dup):
+        flags = (qos << 1) | (PUBLISH_RETAIN if retain else 0) | (PUBLISH_DUP if dup else 0)
+        variable_header = encode_string(topic)
+        if qos:
+            variable_header += struct.pack('>H', packet_id)
+        self._acked.clear()
+        self._pending_id = packet_id
+        writer = self._writer
+        # Header and payload are written back to back, nothing else gets in between
+        writer.write(bytes((PUBLISH | flags, )) + encode_length(len(variable_header) + len(payload)) + variable_header)
+        writer.write(payload)
+        await writer.drain()
+        if qos:
+            await uasyncio.wait_for(self._acked.wait(), self.timeout)
+            if self._writer is not writer:
+                raise MqttError('Connection lost before the PUBACK')
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        """
+        Publish `payload`, at QoS 1 it returns once the broker acknowledged it
+        A publish failing on a connection that was already open is sent again, once, on a new one
+        """
+        packet_id = self._next_packet_id() if qos else 0
+        dup = False
+        while True:
+            reused = self.connected
+            try:
+                if not reused:
+                    await self.connect()
+                await self._send_publish(topic, payload, qos, retain, packet_id, dup)
+                return
+            except (OSError, uasyncio.TimeoutError):
+                self.close()
+                if not reused:
+                    raise
+                # Same packet id, so the broker can tell it's the same message if it got it after all
+                dup = qos > 0
+            finally:
+                self._pending_id = None
+
+
+class MqttPublisher:
+    """
+    Sink of the export pipeline publishing the lines of every probe cycle as a single message
+    Messages that couldn't be published are kept and sent along the next ones,
+    oldest lines are dropped past `max_bytes` of them
+    """
+
+    network = True
+
+    def __init__(self, client, topic, qos=1, retain=False, max_bytes=16384):
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        self.max_bytes = max_bytes
+        self._batch = []
+        self._batch_length = 0
+
+    def add_lines(self, lines):
+        self._batch.append(bytes(lines))
+        self._batch_length += len(lines) + 1
+        while self._batch_length > self.max_bytes and len(self._batch) > 1:
+            self._batch_length -= len(self._batch.pop(0)) + 1
+
+    def count_cycle(self):
+        return True
+
+    async def export_async(self):
+        if not self._batch:
+            return None
+        batch, self._batch, self._batch_length = self._batch, [], 0
+        try:
+            await self.client.publish(self.topic, b'\n'.join(batch), self.qos, self.retain)
+        except Exception:
+            # Kept in front of the lines added meanwhile
+            for lines in batch:
+                self._batch_length += len(lines) + 1
+            self._batch = batch + self._batch
+            raise
+        return True
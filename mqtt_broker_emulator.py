@@ -0,0 +1,109 @@
+"""
+MQTT broker stand-in on uasyncio streams, to run `mqtt.py` on a PC or the MicroPython unix port without a broker.
+Used by `benchmarks/check_mqtt.py`
+
+    broker = BrokerEmulator(drop_before_puback=1)
+    port = await broker.start()
+    client = MqttClient('127.0.0.1', port)
+
+Only what the publisher needs: CONNECT is accepted, PUBLISH acknowledged at QoS 1 and PINGREQ answered,
+everything received is recorded for the checks
+"""
+
+import struct
+
+import uasyncio
+
+from mqtt import CONNACK, CONNECT, PINGREQ, PINGRESP, PUBACK, PUBLISH, PUBLISH_DUP, CONNECT_CLEAN_SESSION
+
+
+class BrokerEmulator:
+    """
+    Accepts any client. The first `drop_before_puback` connections are closed as soon as a publish comes in,
+    before acknowledging it, which is what a broker restarting or a WiFi dropout looks like to the client
+    """
+
+    def __init__(self, drop_before_puback=0):
+        self.drop_before_puback = drop_before_puback
+        self.connections = 0
+        # (client id, clean session, username, password, keepalive) of every CONNECT
+        self.connects = []
+        # (connection number, topic, qos, dup, packet id, payload) of every PUBLISH
+        self.published = []
+        self.pings = 0
+        self._server = None
+
+    async def start(self, address='127.0.0.1', port=0):
+        """Start listening, returns the port"""
+        self._server = await uasyncio.start_server(self._handle_client, address, port)
+        if port == 0:
+            port = self._server.sockets[0].getsockname()[1]
+        return port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, (await reader.readexactly(length) if length else b'')
+
+    def _parse_connect(self, body):
+        # Protocol name, level, flags, keepalive, then the client id and the credentials
+        offset = 2 + struct.unpack('>H', body[:2])[0]
+        _, flags, keepalive = struct.unpack('>BBH', body[offset:offset + 4])
+        offset += 4
+        strings = []
+        while offset < len(body):
+            length = struct.unpack('>H', body[offset:offset + 2])[0]
+            strings.append(body[offset + 2:offset + 2 + length].decode())
+            offset += 2 + length
+        strings += [None, None]
+        self.connects.append((strings[0], bool(flags & CONNECT_CLEAN_SESSION), strings[1], strings[2], keepalive))
+
+    async def _handle_client(self, reader, writer):
+        self.connections += 1
+        connection = self.connections
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header & 0xF0
+                if packet_type == CONNECT:
+                    self._parse_connect(body)
+                    writer.write(bytes((CONNACK, 2, 0, 0)))
+                elif packet_type == PUBLISH:
+                    qos = (header >> 1) & 0x03
+                    offset = 2 + struct.unpack('>H', body[:2])[0]
+                    topic = body[2:offset].decode()
+                    packet_id = None
+                    if qos:
+                        packet_id = struct.unpack('>H', body[offset:offset + 2])[0]
+                        offset += 2
+                    self.published.append(
+                        (connection, topic, qos, bool(header & PUBLISH_DUP), packet_id, bytes(body[offset:])),
+                    )
+                    if connection <= self.drop_before_puback:
+                        break
+                    if qos:
+                        writer.write(bytes((PUBACK, 2)) + struct.pack('>H', packet_id))
+                elif packet_type == PINGREQ:
+                    self.pings += 1
+                    writer.write(bytes((PINGRESP, 0)))
+                else:
+                    # DISCONNECT, or anything a publisher has no business sending
+                    break
+                await writer.drain()
+        except (EOFError, OSError):
+            # The client is gone
+            pass
+        writer.close()
+        await writer.wait_closed()
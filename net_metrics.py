@@ -1,9 +1,13 @@
 import time
 import network
 import ubinascii
-import urequests
+import usocket
+import ussl
 import gc
 
+from compression import compression_available, gzip_parts
+from line_protocol import format_line, format_lines_multi
+
 
 def connect(ssid=None, password=None, wait_for_connection=20):
     # Connect to WLAN
@@ -25,42 +29,278 @@ def connect(ssid=None, password=None, wait_for_connection=20):
         return None
 
 
-def format_line_value(value):
-    # ToDo: Fill accordingly https://docs.influxdata.com/influxdb/cloud/reference/syntax/line-protocol/#data-types-and-format
-    # So far defaults work fine lol, and this thing only supports floats /shrug
-    return str(value)
+def parse_status_line(line):
+    """`(status_code, reason)` out of the status line of a response"""
+    status = line.split(None, 2)
+    if len(status) < 2:
+        raise OSError('Connection closed before the response')
+    return int(status[1]), status[2].rstrip() if len(status) > 2 else b''
+
+
+def parse_chunk_length(line):
+    """Length of the chunk out of its size line, the chunk is followed by a CRLF, the last one is empty"""
+    return int(line.split(b';')[0], 16)
+
+
+def worth_resending(status_code):
+    """
+    Whether lines the server refused are worth sending again later: the server is down, the credentials are wrong
+    or it's asking to slow down, rather than the lines being wrong
+    """
+    return status_code >= 500 or status_code in (401, 403, 429)
+
+
+class ResponseHeaders:
+    """What the headers of a response tell about its body and the connection, fed a header line at a time"""
+
+    def __init__(self):
+        self.length = 0
+        self.chunked = False
+        self.keep_alive = True
+
+    def feed(self, line):
+        """Take the next header line, returns False once the headers are over"""
+        if not line or line == b'\r\n':
+            return False
+        header = line.split(b':', 1)
+        if len(header) != 2:
+            return True
+        name, value = header[0].strip().lower(), header[1].strip().lower()
+        if name == b'content-length':
+            self.length = int(value)
+        elif name == b'transfer-encoding':
+            self.chunked = value == b'chunked'
+        elif name == b'connection':
+            self.keep_alive = value != b'close'
+        return True
 
 
 class MetricsSender:
+    """
+    Sends the metrics over a single HTTP/1.1 keep-alive connection, kept open between the sends.
+    The TLS handshake is what makes a send slow and memory hungry, so it's only done again when
+    the server closes the connection or it breaks, transparently for the caller
+    """
 
-    def __init__(self, url, username, password) -> None:
+    def __init__(
+            self, url, username, password, timeout=10, batch_cycles=1, batch_bytes=16384, queue=None, compress=False,
+        ) -> None:
+        """
+        Lines added by `add_lines` are sent together every `batch_cycles` probe cycles,
+        or earlier once `batch_bytes` of them are waiting. Lines being batched need client-side timestamps
+        Batches failing to be sent go to the `queue` on the flash, if there's one, see `replay`
+        With `compress` the bodies are gzipped, when the firmware is able to
+        """
         self._url = url
+        parts = url.split('/', 3)
+        proto, host = parts[0], parts[2]
+        # `http://host:8086` has no path at all, it's the root then
+        path = parts[3] if len(parts) > 3 else ''
+        self._tls = proto == 'https:'
+        self._host, self._port = host, 443 if self._tls else 80
+        if ':' in host:
+            self._host, port = host.split(':', 1)
+            self._port = int(port)
+        self._timeout = timeout
+        self._compress = compress and compression_available()
+        if compress and not self._compress:
+            print("Compression isn't available in this firmware, metrics will be sent as they are")
         self._auth_enc = ubinascii.b2a_base64(
             username + ":" + password
         ).rstrip(b'\n')
-    
-    def send_request(self, lines):
+        # Everything but the body length is the same for every request, so the headers are built once
+        self._header_block = b''.join([
+            b'POST /', path.encode(), b' HTTP/1.1\r\n',
+            b'Host: ', host.encode(), b'\r\n',
+            b'Authorization: Basic ', self._auth_enc, b'\r\n',
+            b'Connection: keep-alive\r\n',
+            b'Content-Encoding: gzip\r\n' if self._compress else b'',
+            b'Content-Length: ',
+        ])
+        self._sock = None
+
+        self.batch_cycles = batch_cycles
+        self.batch_bytes = batch_bytes
+        # Lines of the cycles not sent yet, one string per `add_lines` call
+        self._batch = []
+        self._batch_length = 0
+        self._batch_cycle = 0
+        self.queue = queue
+
+    def _connect(self):
         # Sending requests is memory intensive due to SSL
         # So we need to collect the garbage first
         gc.collect()
-        r = urequests.post(
-            self._url,
-            data=lines,
-            headers={
-                'Authorization': b'Basic ' + self._auth_enc,
-            }
-        )
-        r.close()
-        return r.status_code, r.reason
-
-    def _make_base_line(self, name, tags):
-        tags_formatted = ','.join(['='.join(map(str, item)) for item in tags.items()])
-
-        line = name
-        if tags_formatted:
-            line += f',{tags_formatted}'
-        
-        return line
+        address = usocket.getaddrinfo(self._host, self._port, 0, usocket.SOCK_STREAM)[0][-1]
+        sock = usocket.socket()
+        try:
+            sock.settimeout(self._timeout)
+            sock.connect(address)
+            if self._tls:
+                sock = ussl.wrap_socket(sock, server_hostname=self._host)
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _skip(self, length):
+        while length > 0:
+            data = self._sock.read(min(length, 256))
+            if not data:
+                raise OSError('Connection closed while reading the response')
+            length -= len(data)
+
+    def _read_response(self):
+        """Read the whole response, so the connection is ready for the next request"""
+        status_code, reason = parse_status_line(self._sock.readline())
+        headers = ResponseHeaders()
+        while headers.feed(self._sock.readline()):
+            pass
+
+        if headers.chunked:
+            while True:
+                chunk_length = parse_chunk_length(self._sock.readline())
+                self._skip(chunk_length + 2)
+                if not chunk_length:
+                    break
+        else:
+            self._skip(headers.length)
+
+        return status_code, reason, headers.keep_alive
+
+    def _request_head(self, length):
+        """The request line and the headers of a request with a body of `length` bytes"""
+        return self._header_block + str(length).encode() + b'\r\n\r\n'
+
+    def _retry(self, reused):
+        """
+        Drop the connection a request failed on, returns whether it's worth trying again:
+        a connection that was reused was most likely dropped by the server while idle, it's tried once on a fresh one
+        """
+        self.close()
+        return reused
+
+    def _end_request(self, keep_alive):
+        if not keep_alive:
+            self.close()
+
+    def _encode_body(self, lines):
+        """Turn the lines, a string, bytes or a list of bytes parts to be joined by newlines, into the request body"""
+        if isinstance(lines, (list, tuple)):
+            if self._compress:
+                # The parts are compressed one by one, they're never joined uncompressed
+                return gzip_parts(lines)
+            lines = b'\n'.join(lines)
+        elif self._compress:
+            return gzip_parts((lines, ))
+
+        if isinstance(lines, str):
+            lines = lines.encode()
+        return lines
+
+    def send_request(self, lines):
+        lines = self._encode_body(lines)
+
+        while True:
+            reused = self._sock is not None
+            try:
+                if not reused:
+                    self._connect()
+                self._sock.write(self._request_head(len(lines)))
+                self._sock.write(lines)
+                status_code, reason, keep_alive = self._read_response()
+            except OSError:
+                if self._retry(reused):
+                    continue
+                raise
+
+            self._end_request(keep_alive)
+            return status_code, reason
+
+    def add_lines(self, lines):
+        """
+        Queue lines for the next batch, a string or the bytes of a `LineWriter`
+        Without a queue on the flash, batches failing to be sent are kept in memory,
+        oldest lines are dropped past 4 times `batch_bytes` though
+        """
+        # Kept as bytes, a copy of the `LineWriter` buffer being written again next cycle
+        lines = lines.encode() if isinstance(lines, str) else bytes(lines)
+        self._batch.append(lines)
+        self._batch_length += len(lines) + 1
+        self._trim_batch()
+
+    def _trim_batch(self):
+        while self._batch_length > self.batch_bytes * 4 and len(self._batch) > 1:
+            self._batch_length -= len(self._batch.pop(0)) + 1
+
+    def count_cycle(self):
+        """Count a probe cycle, returns whether the batch is due"""
+        self._batch_cycle += 1
+        return self._batch_cycle >= self.batch_cycles or self._batch_length >= self.batch_bytes
+
+    def end_cycle(self):
+        """
+        Count a probe cycle and send the batch when it's due
+        Returns the `(status_code, reason)` of the request, or None when the batch isn't due yet
+        """
+        if not self.count_cycle():
+            return None
+        return self.flush()
+
+    def _take_batch(self):
+        """The batch to send, the lines added from now on go to the next one"""
+        batch = self._batch
+        self._batch = []
+        self._batch_length = 0
+        self._batch_cycle = 0
+        return batch
+
+    def flush(self):
+        """Send all the lines batched so far in a single request"""
+        if not self._batch:
+            return None
+        batch = self._take_batch()
+        try:
+            result = self.send_request(batch)
+        except Exception:
+            self._park(batch)
+            raise
+
+        if worth_resending(result[0]):
+            self._park(batch)
+        return result
+
+    def _park(self, batch):
+        """Move a batch that failed to be sent to the queue on the flash, or keep it for the next flush"""
+        if self.queue is not None:
+            self.queue.push(b'\n'.join(batch))
+            return
+        self._batch = batch + self._batch
+        self._batch_length += sum(len(lines) + 1 for lines in batch)
+        self._trim_batch()
+
+    def _send_delivered(self, body):
+        status_code, reason = self.send_request(body)
+        if worth_resending(status_code):
+            raise OSError(f'Metrics server replied {status_code} {reason}')
+
+    def replay(self, max_bytes=8192):
+        """
+        Send a batch of the lines queued on the flash, returns how many bytes were sent
+        Meant to be called after a successful flush, so the live lines always go first
+        and the backlog only takes one more request per flush
+        """
+        if self.queue is None:
+            return 0
+        return self.queue.replay(self._send_delivered, max_bytes)
 
     def send_metric(self, name, tags, fields, timestamp=None):
         """Send metrics to grafana
@@ -96,26 +336,20 @@ class MetricsSender:
             fields (dict): Fields data that'll be sent
 
         """
-        line = self._make_base_line(name, tags)
-        # Here we build `name1=value,name2=value` resulting string
-        # while value through appropriate data-type formatter(serializer)
-        fields_formatted = ','.join(['='.join(item) for item in zip(
-            map(str, fields.keys()),
-            map(format_line_value, fields.values()),
-        )])
-        line += f' {fields_formatted}'
-
-        if timestamp != None:
-            line += f' {timestamp}'
-
-        return self.send_request(line)
+        return self.send_request(format_line(name, tags, fields, timestamp))
 
     def send_metrics_multi(self, name, tags, fields_data):
         """Send multiple metrics in a single request.
+        See `format_metrics_multi` for the details."""
+        return self.send_request(self.format_metrics_multi(name, tags, fields_data))
+
+    def format_metrics_multi(self, name, tags, fields_data, timestamp=None):
+        """Format multiple metrics into lines ready for `send_request`, so several batches can be sent together.
         All the other parameters are the same as in  `send_metric`.
 
         Attributes:
             fields_data(dict): Multiple fields data, see the example
+            timestamp: Timestamp of all the lines, except the values having their own
 
         Example:
             send_metric(
@@ -142,21 +376,108 @@ class MetricsSender:
             power_data,location=testing,meter_address=51,line=b line_current=5
             power_data,location=testing,meter_address=51,line=c line_current=0
         """
-        base_line = self._make_base_line(name, tags)
-
-        lines = []
-        for field_name, tagged_values in fields_data.items():
-            if not isinstance(tagged_values, dict):  # We can have a single value here
-                field_value = tagged_values if type(tagged_values) is not tuple else tagged_values[0]
-                lines.append(
-                    base_line + f' {field_name}={field_value}' + ('' if type(tagged_values) is not tuple else tagged_values[1])
-                )
-                continue
-
-            for tag, value in tagged_values.items():
-                field_value = value if type(value) is not tuple else value[0]
-                lines.append(
-                    base_line + f',{tag} {field_name}={field_value}' + ('' if type(value) is not tuple else value[1])
-                )
-
-        return self.send_request('\n'.join(lines))
+        return format_lines_multi(name, tags, fields_data, timestamp)
+
+
+class UdpMetricsSender:
+    """
+    Sends the lines as UDP datagrams, the way InfluxDB and Telegraf take them on their UDP listeners.
+    No handshake and no response to wait for, so it's cheap enough to send every second, but nothing tells
+    whether the lines made it either: they're sent and forgotten
+    Lines are packed into datagrams of at most `max_datagram` bytes, which fit in a single WiFi frame by default
+    It's a sink of the export pipeline too, see `exporters.py`
+    """
+
+    network = True
+
+    def __init__(self, host, port=8089, max_datagram=1472):
+        self._host = host
+        self._port = port
+        self.max_datagram = max_datagram
+        self._address = None
+        self._sock = None
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self._batch = []
+
+    def _open(self):
+        if self._sock is None:
+            self._address = usocket.getaddrinfo(self._host, self._port, 0, usocket.SOCK_DGRAM)[0][-1]
+            self._sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _datagrams(self, body):
+        """Cut the lines into datagrams at the line boundaries, without copying them"""
+        view = memoryview(body)
+        start = 0
+        while start < len(body):
+            end = start + self.max_datagram
+            if end >= len(body):
+                end = len(body)
+            else:
+                # The newline right after a full datagram is a boundary too
+                cut = body.rfind(b'\n', start, end + 1)
+                if cut < start:
+                    # A single line longer than a datagram, it goes whole and gets fragmented
+                    cut = body.find(b'\n', end)
+                    if cut < 0:
+                        cut = len(body)
+                end = cut
+            if end > start:
+                yield view[start:end]
+            start = end + 1
+
+    def send_request(self, lines):
+        """
+        Send the lines, a string, bytes or a list of bytes parts to be joined by newlines
+        Returns the number of bytes sent, the socket raising is all that can go wrong
+        """
+        if isinstance(lines, str):
+            lines = lines.encode()
+        parts = lines if isinstance(lines, (list, tuple)) else (lines, )
+
+        self._open()
+        sent = 0
+        try:
+            for part in parts:
+                for datagram in self._datagrams(part):
+                    self._sock.sendto(datagram, self._address)
+                    self.packets_sent += 1
+                    sent += len(datagram)
+        except OSError:
+            # Resolved again next time, in case the target moved
+            self.close()
+            raise
+        finally:
+            self.bytes_sent += sent
+        return sent
+
+    def send_metric(self, name, tags, fields, timestamp=None):
+        """Same as `MetricsSender.send_metric`"""
+        return self.send_request(format_line(name, tags, fields, timestamp))
+
+    def send_metrics_multi(self, name, tags, fields_data):
+        """Same as `MetricsSender.send_metrics_multi`"""
+        return self.send_request(format_lines_multi(name, tags, fields_data))
+
+    def add_lines(self, lines):
+        self._batch.append(bytes(lines))
+
+    def count_cycle(self):
+        return True
+
+    async def export_async(self):
+        """Send the lines of the probe right away, there's nothing to wait for"""
+        if not self._batch:
+            return None
+        batch, self._batch = self._batch, []
+        self.send_request(batch)
+        return True
+
+    def fields(self):
+        """Counters of the datagrams sent"""
+        return {'packets_sent': self.packets_sent, 'bytes_sent': self.bytes_sent}
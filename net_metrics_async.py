@@ -0,0 +1,156 @@
+"""
+Metrics sender on uasyncio streams: connecting, the TLS handshake, sending the body and waiting for the response
+all yield to the event loop, so the control server and the probes keep running during a send
+"""
+
+import gc
+
+import uasyncio
+
+from exporters import Rejected
+from net_metrics import MetricsSender, ResponseHeaders, parse_chunk_length, parse_status_line, worth_resending
+
+
+class AsyncMetricsSender(MetricsSender):
+    """
+    Subclass of MetricsSender that also implements `end_cycle_async`, `flush_async` and `replay_async`
+    Same keep-alive connection, batching and queue, the blocking methods keep working too
+    but must not be used while an async send is running
+    It's a sink of the export pipeline too, see `exporters.py`
+    """
+
+    network = True
+
+    def __init__(self, *args, replay_bytes=8192, **kwargs):
+        """Constructor. Same arguments as MetricsSender, plus the bytes of the queue replayed along every delivery"""
+        super(AsyncMetricsSender, self).__init__(*args, **kwargs)
+        self.replay_bytes = replay_bytes
+        self._reader = None
+        self._writer = None
+
+    async def _connect_async(self):
+        # The TLS handshake is memory hungry, same as for the blocking connection
+        gc.collect()
+        self._reader, self._writer = await uasyncio.open_connection(
+            self._host, self._port, ssl=self._tls or None, server_hostname=self._host if self._tls else None,
+        )
+
+    def close(self):
+        super(AsyncMetricsSender, self).close()
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+            self._reader = self._writer = None
+
+    def _body_parts(self, lines):
+        """The parts of the body and its length, uncompressed batches are written part by part, never joined"""
+        if isinstance(lines, (list, tuple)) and not self._compress:
+            return lines, (sum(len(part) + 1 for part in lines) - 1 if lines else 0)
+        body = self._encode_body(lines)
+        return (body, ), len(body)
+
+    async def _skip_async(self, length):
+        while length > 0:
+            data = await self._reader.read(min(length, 256))
+            if not data:
+                raise OSError('Connection closed while reading the response')
+            length -= len(data)
+
+    async def _read_response_async(self):
+        """Same as `_read_response`, on the stream"""
+        status_code, reason = parse_status_line(await self._reader.readline())
+        headers = ResponseHeaders()
+        while headers.feed(await self._reader.readline()):
+            pass
+
+        if headers.chunked:
+            while True:
+                chunk_length = parse_chunk_length(await self._reader.readline())
+                await self._skip_async(chunk_length + 2)
+                if not chunk_length:
+                    break
+        else:
+            await self._skip_async(headers.length)
+
+        return status_code, reason, headers.keep_alive
+
+    async def _exchange_async(self, parts, length):
+        """Write the request and read the response on the open connection"""
+        self._writer.write(self._request_head(length))
+        for i, part in enumerate(parts):
+            if i:
+                self._writer.write(b'\n')
+            self._writer.write(part)
+            # A part at a time, so the stream never buffers the whole body
+            await self._writer.drain()
+        return await self._read_response_async()
+
+    async def send_request_async(self, lines):
+        """Same as `send_request`, each attempt bounded by the timeout"""
+        parts, length = self._body_parts(lines)
+
+        while True:
+            reused = self._writer is not None
+            try:
+                if not reused:
+                    await uasyncio.wait_for(self._connect_async(), self._timeout)
+                status_code, reason, keep_alive = await uasyncio.wait_for(
+                    self._exchange_async(parts, length), self._timeout,
+                )
+            except (OSError, uasyncio.TimeoutError):
+                if self._retry(reused):
+                    continue
+                raise
+
+            self._end_request(keep_alive)
+            return status_code, reason
+
+    async def end_cycle_async(self):
+        """Same as `end_cycle`"""
+        if not self.count_cycle():
+            return None
+        return await self.flush_async()
+
+    async def flush_async(self):
+        """Same as `flush`, lines added while it's sending go to the next batch"""
+        if not self._batch:
+            return None
+        batch = self._take_batch()
+        try:
+            result = await self.send_request_async(batch)
+        except Exception:
+            self._park(batch)
+            raise
+
+        if worth_resending(result[0]):
+            self._park(batch)
+        return result
+
+    async def _send_delivered_async(self, body):
+        status_code, reason = await self.send_request_async(body)
+        if worth_resending(status_code):
+            raise OSError(f'Metrics server replied {status_code} {reason}')
+
+    async def replay_async(self, max_bytes=8192):
+        """Same as `replay`"""
+        if self.queue is None:
+            return 0
+        return await self.queue.replay_async(self._send_delivered_async, max_bytes)
+
+    async def export_async(self):
+        """Send the batch when it's due, then catch up with a bit of the backlog once the network is back"""
+        result = await self.end_cycle_async()
+        if result is None:
+            return None
+        status_code, reason = result
+        if status_code >= 400:
+            # Not delivered, and the backlog would be refused just the same, it's only replayed after a delivery
+            raise Rejected(f'Metrics server replied {status_code} {reason.decode()}')
+        try:
+            await self.replay_async(self.replay_bytes)
+        except Exception as e:
+            # The live batch made it, the backlog waits for the next delivery
+            print(f'Failed to replay the queued metrics: {e}')
+        return True
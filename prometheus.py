@@ -0,0 +1,115 @@
+"""
+Prometheus text exposition of the latest probe, see https://prometheus.io/docs/instrumenting/exposition_formats/
+Takes the same measurements, tags and fields as the line protocol writer, so the metrics are the same either way:
+a field becomes `<prefix>_<measurement>_<field>`, the tags and the tag of a value (e.g. 'line=A') become labels
+
+The body is rendered once at the end of a probe and served as it is by every scrape
+"""
+
+_NAME_CHARACTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_:'
+
+
+def metric_name(name):
+    """Replace whatever isn't allowed in a metric or label name with underscores"""
+    name = ''.join(character if character in _NAME_CHARACTERS else '_' for character in str(name))
+    return '_' + name if name[:1].isdigit() else name
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_sample_value(value):
+    """Prometheus only has floats, booleans are 1 or 0. None for the values it can't hold, like strings"""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    if isinstance(value, int):
+        return str(value)
+    return None
+
+
+class Exposition:
+    """
+    Samples of a probe grouped by metric, as the format wants all the samples of a metric together
+    Metric names and label sets are built once and cached, the set of series doesn't change between probes
+    """
+
+    def __init__(self, prefix='powermon', max_series=64):
+        self.prefix = prefix
+        self.max_series = max_series
+        # The body served to the scrapes, the previous probe until the next one is rendered
+        self.body = b''
+        # metric name -> samples of the probe being collected, in the order the metrics show up
+        self._samples = {}
+        # (measurement, field) -> metric name
+        self._names = {}
+        # (tags items, tag of the value) -> `{label="value",...}`
+        self._labels = {}
+
+    def _metric_name(self, name, field_name):
+        try:
+            return self._names[(name, field_name)]
+        except KeyError:
+            metric = self._names[(name, field_name)] = metric_name(f'{self.prefix}_{name}_{field_name}')
+            return metric
+
+    def _label_block(self, tags, tag):
+        key = (tuple(tags.items()), tag)
+        try:
+            return self._labels[key]
+        except KeyError:
+            pass
+        if len(self._labels) >= self.max_series:
+            # Tags changing from probe to probe would grow it forever, start over
+            self._labels.clear()
+        labels = [f'{metric_name(label)}="{escape_label_value(value)}"' for label, value in tags.items()]
+        if tag is not None:
+            label, _, value = str(tag).partition('=')
+            labels.append(f'{metric_name(label)}="{escape_label_value(value)}"')
+        block = self._labels[key] = '{' + ','.join(labels) + '}' if labels else ''
+        return block
+
+    def _add_sample(self, name, field_name, labels, value):
+        if type(value) is tuple:
+            # Timestamped value of a batch, the scrape time is what Prometheus goes by
+            value = value[0]
+        value = format_sample_value(value)
+        if value is None:
+            return
+        metric = self._metric_name(name, field_name)
+        samples = self._samples.get(metric)
+        if samples is None:
+            samples = self._samples[metric] = []
+        samples.append(metric + labels + ' ' + value)
+
+    def add(self, name, tags, fields):
+        """Add the fields of a single series, see `LineWriter.write_line`"""
+        labels = self._label_block(tags, None)
+        for field_name, value in fields.items():
+            self._add_sample(name, field_name, labels, value)
+
+    def add_multi(self, name, tags, fields_data):
+        """Add the fields of tagged values, see `LineWriter.write_lines_multi`"""
+        for field_name, tagged_values in fields_data.items():
+            if not isinstance(tagged_values, dict):  # We can have a single value here
+                self._add_sample(name, field_name, self._label_block(tags, None), tagged_values)
+                continue
+            for tag, value in tagged_values.items():
+                self._add_sample(name, field_name, self._label_block(tags, tag), value)
+
+    def render(self):
+        """Build the body served from now on out of the samples added since the last render"""
+        lines = []
+        for metric, samples in self._samples.items():
+            lines.append('# TYPE ' + metric + ' gauge')
+            lines.extend(samples)
+        lines.append('')
+        self.body = '\n'.join(lines).encode()
+        self._samples = {}
+        return self.body
@@ -0,0 +1,58 @@
+"""
+Latest meter readings kept as Modbus registers, at the addresses and in the encoding of the meter profiles,
+so a Modbus TCP client reads the same registers it would read from the meter itself without touching RS-485
+
+    bank = RegisterBank()
+    bank.add_meter(1, DTS6619.PROFILE)
+    uasyncio.create_task(TcpServer(bank, port=502).start())
+    ...
+    bank.update(1, readings)
+"""
+
+import modbus.defines as cst
+from modbus.modbus import Databank
+
+from meter_profile import plan_reads
+
+
+class MeterRegisters:
+    """The registers of a single meter, held by a modbus Slave in blocks covering the spans of its profile"""
+
+    def __init__(self, slave, profile):
+        self.slave = slave
+        self.profile = profile
+        # register name -> name of the block holding it
+        self._block_names = {}
+
+        block_type = cst.ANALOG_INPUTS if profile.function_code == cst.READ_INPUT_REGISTERS else cst.HOLDING_REGISTERS
+        for starting_address, quantity, registers in plan_reads(profile.registers, profile.register_names):
+            block_name = f'registers_{starting_address}'
+            slave.add_block(block_name, block_type, starting_address, quantity)
+            for name, _ in registers:
+                self._block_names[name] = block_name
+
+    def set_value(self, name, value):
+        """Change the value held by a register"""
+        self.slave.set_values(self._block_names[name], self.profile.registers[name][0], self.profile.encode(name, value))
+
+    def update(self, readings):
+        """Set all the registers read, the others keep their last values"""
+        for name, value in readings.items():
+            if name in self._block_names:
+                self.set_value(name, value)
+
+
+class RegisterBank(Databank):
+    """A databank with a slave per meter, its unit id being the address of the meter on the RS-485 line"""
+
+    def __init__(self):
+        super().__init__()
+        # meter address -> MeterRegisters
+        self.meters = {}
+
+    def add_meter(self, address, profile):
+        self.meters[address] = MeterRegisters(self.add_slave(address), profile)
+
+    def update(self, address, readings):
+        """Store the readings of a poll, meters that weren't polled keep serving their last readings"""
+        self.meters[address].update(readings)